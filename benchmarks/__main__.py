@@ -0,0 +1,54 @@
+import argparse
+import json
+
+from benchmarks import crawl, limiter, writes
+from benchmarks.common import report
+from ukcensus.ReplayServer import DEFAULT_COLLECTION, ReplayServer
+
+BENCHMARKS = ("limiter", "crawl", "writes")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks against the ReplayServer",
+                                     epilog="run from the repository root: python -m benchmarks")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK", help="limiter, crawl or writes, all by default")
+    parser.add_argument("--storage", choices=["sqlite", "postgres"], default="sqlite",
+                        help="postgres runs in the ukcensus_bench schema of the [DB] server")
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION)
+    parser.add_argument("--areas", nargs="*", default=["msoa=200", "lsoa=1000"], metavar="TYPE=COUNT")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered 429")
+    parser.add_argument("--dimensions", type=int, default=2, help="dimensions crawled")
+    parser.add_argument("-n", type=int, default=1, help="dimensions taken at a time")
+    parser.add_argument("--processes", type=int, help="crawl through the orchestrator with this many workers")
+    parser.add_argument("--rows", type=int, default=100000, help="rows written by the writes benchmark")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}, pick from {}".format(name, ", ".join(BENCHMARKS)))
+
+    area_types = {area_type: int(count) for area_type, count in (area.split("=") for area in args.areas)}
+    results = []
+    with ReplayServer(args.collection, area_types=area_types, latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate) as server:
+        for name in args.benchmarks or BENCHMARKS:
+            if name == "limiter":
+                results.append(limiter.run(server))
+                results.append(limiter.run(server, shared=True))
+            elif name == "crawl":
+                results.append(crawl.run(server, args.storage, dimensions=args.dimensions, n=args.n,
+                                         processes=args.processes))
+            elif name == "writes":
+                results.append(writes.run(server, args.storage, rows=args.rows))
+            print(report(results[-1]))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import time
+
+from ukcensus.CensusData import RateLimitedAPI
+from ukcensus.Metrics import metrics
+from ukcensus.RateLimiter import RateLimiter
+
+BENCH_SCHEMA = "ukcensus_bench"
+
+
+def bench_api(server, storage="sqlite", path=None, windows=((1000, 1),), pace=True):
+    """
+    RateLimitedAPI reading from the ReplayServer into an empty store: a
+    fresh SQLite file, or the BENCH_SCHEMA schema of the [DB] server,
+    dropped and recreated so every run starts the same.
+
+    windows -> rate limit of the run, far above the real API's by default,
+               kept in a temporary state file of its own so orchestrator
+               workers share it instead of the real API's budget
+    """
+    api = RateLimitedAPI()
+    api.base_url = server.url
+    api.cache = None
+    api.limiter = RateLimiter(windows=windows, path=os.path.join(tempfile.mkdtemp(prefix="ukcensus-bench-"), "ratelimit.json"),
+                              pace=pace)
+    api.backoff_base = 0.05
+    api.observation_table = "data_mt"
+
+    if storage == "sqlite":
+        api.storage_backend = "sqlite"
+        api.storage_path = path or os.path.join(tempfile.mkdtemp(prefix="ukcensus-bench-"), "bench.sqlite3")
+        api._storage = None
+        return api
+
+    api.storage_backend = "postgres"
+    api.db_schema = None
+    api._storage = None
+    with api.storage.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(BENCH_SCHEMA))
+    api.storage.pool.close()
+    api.db_schema = BENCH_SCHEMA
+    api._storage = None
+    return api
+
+
+def count_rows(api, table_name):
+    return int(api.get_results_from_database('SELECT count(*) as n FROM "{}"'.format(table_name))['n'][0])
+
+
+def server_requests(server, kind=None):
+    return sum(count for (call_kind, _), count in server.calls.items() if kind is None or call_kind == kind)
+
+
+def counter(snapshot, name):
+    return sum(counter["value"] for counter in snapshot["counters"] if counter["name"] == name)
+
+
+class Timer:
+    def __enter__(self):
+        metrics.snapshot(reset=True)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.start
+        self.metrics = metrics.snapshot()
+
+
+def rate(count, seconds):
+    return round(count / seconds, 1) if seconds else 0.0
+
+
+def report(result):
+    return "{}: {}".format(result["benchmark"], ", ".join(
+        "{} {}".format(name, value) for name, value in result.items() if name != "benchmark"))
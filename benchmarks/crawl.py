@@ -0,0 +1,48 @@
+from benchmarks.common import Timer, bench_api, count_rows, rate, server_requests
+from ukcensus import Orchestrator
+
+
+def load_metadata(api, population_type):
+    api.get_area_types(population_type=population_type)
+    api.get_area_infos(population_type=population_type)
+    dimensions = api.fetch_all_data("population-types/{}/dimensions".format(population_type))
+    api.create_table_if_not_exists("dimensions")
+    with api.bulk_writer("dimensions") as writer:
+        writer.extend(dict(item, **{'population-type': population_type}) for item in dimensions)
+    return [item["id"] for item in dimensions]
+
+
+def run(server, storage="sqlite", population_type="UR", dimensions=2, n=1, processes=None, limit=1000):
+    """
+    End-to-end crawl of the first `dimensions` dimensions of population_type,
+    taken n at a time, after loading its area types, areas and dimensions.
+    processes runs the crawl through the Orchestrator, otherwise it goes
+    through get_multi_final_data in this process.
+    """
+    api = bench_api(server, storage, windows=((limit, 1),))
+    start_requests = server_requests(server)
+
+    with Timer() as metadata:
+        dimension_ids = load_metadata(api, population_type)[:dimensions]
+    metadata_requests = server_requests(server) - start_requests
+
+    start_requests = server_requests(server, "census-observations")
+    with Timer() as timer:
+        if processes:
+            Orchestrator.crawl(api, population_types=[population_type], dimensions=[dimension_ids], n=n,
+                               processes=processes, shard_size=api.shard_size)
+        else:
+            api.get_multi_final_data(population_type, dimension=[dimension_ids], how="all", n=n)
+    requests = server_requests(server, "census-observations") - start_requests
+    rows = count_rows(api, api.observation_table)
+
+    return {
+        "benchmark": "crawl ({}{})".format(storage, ", {} processes".format(processes) if processes else ""),
+        "metadata_requests": metadata_requests,
+        "metadata_s": round(metadata.seconds, 2),
+        "requests": requests,
+        "rows": rows,
+        "seconds": round(timer.seconds, 2),
+        "requests_per_s": rate(requests, timer.seconds),
+        "rows_per_s": rate(rows, timer.seconds),
+    }
@@ -0,0 +1,29 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import Timer, bench_api, counter, rate
+from ukcensus.RateLimiter import RateLimiter
+
+
+def run(server, requests=300, limit=100, threads=8, shared=False):
+    """
+    Requests per second make_request reaches under a limit of `limit` calls
+    a second, from `threads` threads; shared keeps the limiter state in a
+    file as the multi-process crawl does.
+    """
+    api = bench_api(server)
+    path = os.path.join(tempfile.mkdtemp(prefix="ukcensus-bench-"), "ratelimit.json") if shared else None
+    api.limiter = RateLimiter(windows=((limit, 1),), path=path)
+
+    with Timer() as timer, ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda _: api.make_request("population-types", params={"limit": 1}), range(requests)))
+
+    return {
+        "benchmark": "limiter" + (" (shared file)" if shared else ""),
+        "requests": requests,
+        "seconds": round(timer.seconds, 2),
+        "requests_per_s": rate(requests, timer.seconds),
+        "limit_per_s": limit,
+        "ratelimit_sleep_s": round(counter(timer.metrics, "ukcensus_ratelimit_sleep_seconds_total"), 2),
+    }
@@ -0,0 +1,43 @@
+from benchmarks.common import Timer, bench_api, count_rows, counter, rate
+
+
+def observation_items(server, population_type, rows):
+    """
+    At least `rows` census-observations items as the crawl stores them, made
+    by the ReplayServer without going through HTTP.
+    """
+    dimension_ids = ["health_in_general", "highest_qualification"]
+    items = []
+    area_codes = iter("E01{:06d}".format(i) for i in range(1, 10 ** 6))
+    tags = {'population-type': population_type, 'dimension-id': dimension_ids}
+    while len(items) < rows:
+        items.extend(dict(item, **tags) for item in server.observations("lsoa", [next(area_codes)], dimension_ids))
+    return items[:rows]
+
+
+def run(server, storage="sqlite", population_type="UR", rows=100000):
+    """
+    Rows per second written through the bulk writer into the observation
+    table, and read back as Arrow batches.
+    """
+    api = bench_api(server, storage)
+    items = observation_items(server, population_type, rows)
+    api.create_table_if_not_exists(api.observation_table)
+
+    with Timer() as write:
+        with api.bulk_writer(api.observation_table) as writer:
+            writer.extend(items)
+    written = count_rows(api, api.observation_table)
+
+    with Timer() as read:
+        read_rows = sum(batch.num_rows for batch in api.iter_batches_from_database(
+            'SELECT data FROM "{}"'.format(api.observation_table)))
+
+    return {
+        "benchmark": "writes ({})".format(storage),
+        "rows": written,
+        "write_s": round(write.seconds, 2),
+        "write_rows_per_s": rate(counter(write.metrics, "ukcensus_db_rows_written_total"), write.seconds),
+        "read_s": round(read.seconds, 2),
+        "read_rows_per_s": rate(read_rows, read.seconds),
+    }
@@ -0,0 +1,77 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ukcensus.Batcher import AreaBatch
+
+
+class AsyncCrawler:
+    """
+    Keeps up to `concurrency` census-observation requests in flight while
+    staying under the API budget shared through api.limiter.
+
+    api -> RateLimitedAPI used to send the requests
+    concurrency -> number of requests in flight at once
+    """
+    def __init__(self, api, concurrency=8):
+        self.api = api
+        self.concurrency = concurrency
+
+    async def wait_for_slot(self):
+        wait_time = self.api.limiter.reserve()
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    async def fetch(self, loop, executor, endpoint):
+        cached = await loop.run_in_executor(executor, self.api.cached_response, endpoint)
+        if cached is not None and cached.fresh:
+            response = cached.body
+        else:
+            await self.wait_for_slot()
+            response = await loop.run_in_executor(executor, self.api.send_request, endpoint, {}, cached)
+        if response is None:
+            return None
+        return response.get("observations") or []
+
+    async def run(self, units, on_result, on_error=None):
+        """
+        units -> iterable of (endpoint, tags, ...); tags are merged into
+                 every observation returned for that endpoint
+        on_result -> called with the unit and its tagged observations, an
+                     empty list when the API had nothing for it; an
+                     AreaBatch unit the API refuses is split in two and
+                     retried instead
+        on_error -> called with the unit and the exception when a fetch
+                    fails, without it the first failure stops the crawl
+        """
+        loop = asyncio.get_running_loop()
+        units = iter(units)
+        retries = deque()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            async def worker():
+                while True:
+                    unit = retries.popleft() if retries else next(units, None)
+                    if unit is None:
+                        return
+                    endpoint, tags = unit[0], unit[1]
+                    try:
+                        items = await self.fetch(loop, executor, endpoint)
+                    except Exception as e:
+                        if on_error is None:
+                            raise
+                        await loop.run_in_executor(executor, on_error, unit, e)
+                        continue
+                    if items is None:
+                        batch = unit[2] if len(unit) > 2 else None
+                        if isinstance(batch, AreaBatch) and len(batch) > 1:
+                            retries.extend(half.unit(self.api) for half in batch.split())
+                            continue
+                        items = []
+                    items = [dict(item, **tags) for item in items]
+                    await loop.run_in_executor(executor, on_result, unit, items)
+
+            await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+
+    def crawl(self, units, on_result, on_error=None):
+        asyncio.run(self.run(units, on_result, on_error))
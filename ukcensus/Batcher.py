@@ -0,0 +1,90 @@
+from collections import Counter
+
+
+class AreaBatch:
+    """
+    Area codes of one area type requested in a single census-observations
+    call, `area-type=<type>,<code>,<code>,...`, for the same population type
+    and dimensions. Every observation names its area, so the response is
+    stored as is and only split back for per-area bookkeeping.
+
+    areas -> list of (area_code, manifest id or None)
+    """
+
+    def __init__(self, population_type, dimension_ids, area_type, areas):
+        self.population_type = population_type
+        self.dimension_ids = list(dimension_ids)
+        self.area_type = area_type
+        self.areas = list(areas)
+
+    def __len__(self):
+        return len(self.areas)
+
+    def same_request(self, population_type, dimension_ids, area_type):
+        return (population_type, list(dimension_ids), area_type) == (self.population_type, self.dimension_ids, self.area_type)
+
+    def endpoint(self, api):
+        area_codes = ','.join(area_code for area_code, _ in self.areas)
+        return api.observation_endpoint(self.population_type, self.area_type, area_codes, ','.join(self.dimension_ids))
+
+    def tags(self):
+        tag = self.dimension_ids[0] if len(self.dimension_ids) == 1 else self.dimension_ids
+        return {'population-type': self.population_type, 'dimension-id': tag}
+
+    def unit(self, api):
+        """
+        The batch as an AsyncCrawler unit (endpoint, tags, batch).
+        """
+        return self.endpoint(api), self.tags(), self
+
+    def split(self):
+        middle = len(self.areas) // 2
+        return [
+            AreaBatch(self.population_type, self.dimension_ids, self.area_type, self.areas[:middle]),
+            AreaBatch(self.population_type, self.dimension_ids, self.area_type, self.areas[middle:]),
+        ]
+
+    def area_code(self, item):
+        """
+        Area code of an observation of the batch, None if it has none.
+        """
+        for dimension in item['dimensions']:
+            if dimension['dimension_id'] == self.area_type:
+                return dimension['option_id']
+
+    def rows_per_area(self, items):
+        """
+        Observation count of every area in the batch, 0 for areas the API
+        returned nothing for.
+        """
+        counts = Counter(self.area_code(item) for item in items)
+        return {area_code: counts[area_code] for area_code, _ in self.areas}
+
+
+def batch_areas(units, api, max_url_length=2000, max_areas=None):
+    """
+    Packs consecutive units that only differ in area code into AreaBatches,
+    keeping every request url under max_url_length characters.
+
+    units -> (population_type, dimension_ids, area_type, area_code[, manifest id])
+    max_areas -> area codes per batch, unlimited by default
+    """
+    batch = None
+    url_length = 0
+    for unit in units:
+        population_type, dimension_ids, area_type, area_code = unit[:4]
+        area = (area_code, unit[4] if len(unit) > 4 else None)
+        if batch is not None and batch.same_request(population_type, dimension_ids, area_type) \
+                and url_length + len(area_code) + 1 <= max_url_length \
+                and (not max_areas or len(batch) < max_areas):
+            batch.areas.append(area)
+            url_length += len(area_code) + 1
+            continue
+
+        if batch is not None:
+            yield batch
+        batch = AreaBatch(population_type, dimension_ids, area_type, [area])
+        url_length = len("{}/{}".format(api.base_url, batch.endpoint(api)))
+
+    if batch is not None:
+        yield batch
@@ -0,0 +1,109 @@
+import io
+import json
+import threading
+import time
+
+from ukcensus.Metrics import metrics
+
+
+def copy_field(value):
+    """
+    Formats one value for COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, (list, tuple)):
+        value = '{' + ','.join('"{}"'.format(str(v).replace('\\', '\\\\').replace('"', '\\"')) for v in value) + '}'
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def json_row(item):
+    return (item,)
+
+
+class BulkWriter:
+    """
+    Buffers rows for one table and writes them with COPY FROM STDIN, one
+    transaction per batch. Safe to feed from several threads.
+
+    pool -> ConnectionPool to write through
+    table_name -> table to copy into
+    batch_size -> rows buffered before a flush
+    flush_interval -> seconds after which a non-empty buffer is flushed on
+                      the next add, even if the batch is not full
+    columns -> columns filled by COPY, a single `data JSONB` by default
+    to_row -> turns an item into a tuple of column values
+    """
+
+    def __init__(self, pool, table_name, batch_size=1000, flush_interval=5, columns=("data",), to_row=json_row):
+        self.pool = pool
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.columns = columns
+        self.to_row = to_row
+        self.lock = threading.Lock()
+        self.items = []
+        self.last_flush = time.monotonic()
+        self.rows_written = 0
+
+    def add(self, item):
+        self.extend([item])
+
+    def extend(self, items):
+        with self.lock:
+            self.items.extend(items)
+            due = time.monotonic() - self.last_flush >= self.flush_interval
+            if len(self.items) < self.batch_size and not due:
+                return
+            batch = self.take()
+        self.write(batch)
+
+    def take(self):
+        batch, self.items = self.items, []
+        self.last_flush = time.monotonic()
+        return batch
+
+    def flush(self):
+        with self.lock:
+            batch = self.take()
+        self.write(batch)
+
+    def copy(self, cursor, batch):
+        """
+        COPYs batch through cursor, inside the caller's transaction.
+        """
+        buffer = io.StringIO()
+        for item in batch:
+            buffer.write('\t'.join(copy_field(value) for value in self.to_row(item)))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        copy_query = 'COPY "{}" ({}) FROM STDIN'.format(self.table_name, ', '.join(self.columns))
+        cursor.copy_expert(copy_query, buffer)
+
+    def write(self, batch):
+        if not batch:
+            return
+
+        with metrics.timer("ukcensus_db_seconds", operation="write", table=self.table_name):
+            with self.pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    self.copy(cursor, batch)
+
+        with self.lock:
+            self.rows_written += len(batch)
+        metrics.inc("ukcensus_db_rows_written_total", len(batch), table=self.table_name)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,164 @@
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from psycopg2.errors import UndefinedTable
+
+
+class TextIndex:
+    """
+    Sorted keys with a trigram index for exact, prefix and substring lookup.
+    """
+
+    def __init__(self, keys=()):
+        self.keys = sorted(set(keys))
+        self.members = set(self.keys)
+        self.trigrams = defaultdict(set)
+        for key in self.keys:
+            for i in range(len(key) - 2):
+                self.trigrams[key[i:i + 3]].add(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.members
+
+    def exact(self, term):
+        return [term] if term in self.members else []
+
+    def prefix(self, term):
+        start = bisect_left(self.keys, term)
+        end = start
+        while end < len(self.keys) and self.keys[end].startswith(term):
+            end += 1
+        return self.keys[start:end]
+
+    def substring(self, term):
+        if len(term) < 3:
+            return [key for key in self.keys if term in key]
+        grams = [self.trigrams.get(term[i:i + 3], set()) for i in range(len(term) - 2)]
+        candidates = set.intersection(*sorted(grams, key=len))
+        return sorted(key for key in candidates if term in key)
+
+    def search(self, term, how="substring"):
+        """
+        how -> exact, prefix or substring
+        """
+        if how not in ("exact", "prefix", "substring"):
+            raise ValueError("how can only be exact, prefix or substring")
+        return getattr(self, how)(term)
+
+
+class MetadataCatalog:
+    """
+    Population types, area types, area codes, dimensions and categorisations
+    held in memory so metadata lookups skip the database.
+    """
+
+    def __init__(self):
+        self.population_types = []
+        self.area_types = {}
+        self.area_codes = {}
+        self.dimensions = {}
+        self.categorisations = {}
+
+    def microdata(self):
+        return [item['name'] for item in self.population_types if item.get('type') == 'microdata']
+
+    def warm_up(self, api, source="db", categorisations=False):
+        """
+        source -> db reads the cache tables, api downloads the metadata
+        categorisations -> with source=api also download the categorisations
+                           of every dimension, one request each
+        """
+        if source == "db":
+            self.load_from_database(api)
+        elif source == "api":
+            self.load_from_api(api, categorisations=categorisations)
+        else:
+            raise ValueError("source can only be db or api")
+        return self
+
+    def load_from_database(self, api):
+        queries = {
+            'population-types': """SELECT data FROM "population-types" """,
+            'area-types': """SELECT data->>'id' as id, data->>'population-type' as population FROM "area-types" """,
+            'area-infos': """SELECT data->>'id' as id, data->>'area_type' as area_type FROM "area-infos" """,
+            'dimensions': """SELECT data->>'id' as id, data->>'population-type' as population FROM "dimensions" """,
+            'categories': """SELECT data->>'dimension' as dimension, data FROM "categories" """,
+        }
+
+        def query(select_query):
+            try:
+                return api.get_results_from_database(select_query)
+            except UndefinedTable:
+                return pd.DataFrame(columns=['id', 'population', 'area_type', 'dimension', 'data'])
+
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = {name: executor.submit(query, select_query) for name, select_query in queries.items()}
+            frames = {name: future.result() for name, future in futures.items()}
+
+        self.population_types = frames['population-types']['data'].to_list()
+        self.area_types = self.group(frames['area-types'], 'population', 'id')
+        self.area_codes = self.group(frames['area-infos'], 'area_type', 'id')
+        self.dimensions = {k: TextIndex(v) for k, v in self.group(frames['dimensions'], 'population', 'id').items()}
+        self.categorisations = self.group(frames['categories'], 'dimension', 'data')
+
+    def load_from_api(self, api, categorisations=False):
+        self.population_types = api.fetch_all_data("population-types")
+        populations = self.microdata()
+
+        def listing(endpoint):
+            return [item['id'] for item in api.fetch_all_data(endpoint)]
+
+        with ThreadPoolExecutor(max_workers=api.concurrency) as executor:
+            area_types = {pop: executor.submit(listing, 'population-types/{}/area-types'.format(pop)) for pop in populations}
+            dimensions = {pop: executor.submit(listing, 'population-types/{}/dimensions'.format(pop)) for pop in populations}
+            self.area_types = {pop: future.result() for pop, future in area_types.items()}
+            self.dimensions = {pop: TextIndex(future.result()) for pop, future in dimensions.items()}
+
+            area_codes = {}
+            for pop, types in self.area_types.items():
+                for area_type in types:
+                    if area_type not in area_codes:
+                        endpoint = 'population-types/{}/area-types/{}/areas'.format(pop, area_type)
+                        area_codes[area_type] = executor.submit(listing, endpoint)
+            self.area_codes = {area_type: future.result() for area_type, future in area_codes.items()}
+
+            if categorisations:
+                futures = {}
+                for pop, index in self.dimensions.items():
+                    for dimension_id in index.keys:
+                        if dimension_id not in futures:
+                            endpoint = 'population-types/{}/dimensions/{}/categorisations'.format(pop, dimension_id)
+                            futures[dimension_id] = executor.submit(api.fetch_all_data, endpoint)
+                self.categorisations = {dimension_id: future.result() for dimension_id, future in futures.items()}
+
+    @staticmethod
+    def group(frame, key, value):
+        grouped = defaultdict(list)
+        for k, v in zip(frame[key], frame[value]):
+            grouped[k].append(v)
+        return dict(grouped)
+
+    def find_dimensions(self, population_type, term, how="substring"):
+        index = self.dimensions.get(population_type)
+        return index.search(term, how) if index is not None else []
+
+    def area_types_frame(self, population_type=None):
+        if population_type is None:
+            ids = [area_type for types in self.area_types.values() for area_type in types]
+        else:
+            ids = self.area_types.get(population_type, [])
+        return pd.DataFrame({'id': ids})
+
+    def area_codes_frame(self, population_type=None):
+        """
+        Area codes of every area type of the population, in the shape the
+        crawl loops expect (area_code, area_type).
+        """
+        types = self.area_types.get(population_type, []) if population_type else list(self.area_codes)
+        rows = [(code, area_type) for area_type in types for code in self.area_codes.get(area_type, [])]
+        return pd.DataFrame(rows, columns=['area_code', 'area_type'])
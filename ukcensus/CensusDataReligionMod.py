@@ -2,16 +2,25 @@ import requests
 import time
 import pandas as pd
 import polars as pl
-from pandas import json_normalize
-import psycopg2
+import pyarrow as pa
 from psycopg2.errors import UndefinedTable
-import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from configparser import ConfigParser
 
-from ast import literal_eval
-
 from ukcensus.utils import generate_subsets
+from ukcensus.Pipeline import Pipeline, buffer_items
+from ukcensus.FetchedIndex import FetchedIndex
+from ukcensus.Estimate import CrawlEstimate
+from ukcensus.Batcher import batch_areas
+from ukcensus.RateLimiter import get_limiter
+from ukcensus.HttpSession import RETRY_STATUSES, build_session, retry_delay
+from ukcensus.Storage import PostgresStorage, SQLiteStorage
+from ukcensus.ResponseCache import ResponseCache, endpoint_kind
+from ukcensus.Metrics import configure_logging, log, metrics
+from ukcensus.Catalog import MetadataCatalog
     
 class RateLimitedAPI:
     def __init__(self):
@@ -21,6 +30,31 @@ class RateLimitedAPI:
         self.db_url = None
         self.db_user = None
         self.db_password = None
+        self.db_min_connections = 1
+        self.db_max_connections = 10
+        self.db_health_check_interval = 30
+        self._storage = None
+        self.storage_backend = "postgres"
+        self.storage_path = ".cache/ukcensus.sqlite3"
+        self.db_batch_size = 1000
+        self.db_flush_interval = 5
+        self.db_fetch_size = 10000
+        self.concurrency = 8
+        self.page_size = 100
+        self.max_pages = None
+        self.parallel_pages = True
+        self.max_url_length = 2000
+        self.max_batch_areas = None
+        self.rate_limit_file = None
+        self.max_retries = 5
+        self.backoff_base = 1
+        self.backoff_max = 60
+        self.http_timeout = 60
+        self.cache = None
+        self.catalog = None
+        self.pipeline_writers = 2
+        self.pipeline_queue_size = 64
+        self.max_dimensions = None
         self.requests_made = 0
         self.start_time = time.time()
         self.load_config()
@@ -34,75 +68,196 @@ class RateLimitedAPI:
         self.db_url = config.get('DB', 'url')
         self.db_user = config.get('DB', 'username')
         self.db_password = config.get('DB', 'password')
+        self.db_min_connections = config.getint('DB', 'min_connections', fallback=self.db_min_connections)
+        self.db_max_connections = config.getint('DB', 'max_connections', fallback=self.db_max_connections)
+        self.db_health_check_interval = config.getfloat('DB', 'health_check_interval', fallback=self.db_health_check_interval)
+        self.storage_backend = config.get('STORAGE', 'backend', fallback=self.storage_backend)
+        self.storage_path = config.get('STORAGE', 'path', fallback=self.storage_path)
+        if self.storage_backend not in ("postgres", "sqlite"):
+            raise ValueError("[STORAGE] backend can only be postgres or sqlite")
+        self.db_batch_size = config.getint('DB', 'batch_size', fallback=self.db_batch_size)
+        self.db_flush_interval = config.getfloat('DB', 'flush_interval', fallback=self.db_flush_interval)
+        self.db_fetch_size = config.getint('DB', 'fetch_size', fallback=self.db_fetch_size)
+        self.concurrency = config.getint('API', 'concurrency', fallback=self.concurrency)
+        self.page_size = config.getint('API', 'page_size', fallback=self.page_size)
+        max_pages = config.get('API', 'max_pages', fallback='')
+        self.max_pages = int(max_pages) if max_pages else None
+        self.parallel_pages = config.getboolean('API', 'parallel_pages', fallback=self.parallel_pages)
+        self.max_url_length = config.getint('API', 'max_url_length', fallback=self.max_url_length)
+        max_batch_areas = config.get('API', 'max_batch_areas', fallback='')
+        self.max_batch_areas = int(max_batch_areas) if max_batch_areas else None
+        configure_logging(config.get('LOG', 'level', fallback='INFO'))
+        self.rate_limit_file = config.get('API', 'rate_limit_file', fallback=self.rate_limit_file) or None
+        self.limiter = get_limiter(self.rate_limit_file)
+        self.max_retries = config.getint('HTTP', 'max_retries', fallback=self.max_retries)
+        self.backoff_base = config.getfloat('HTTP', 'backoff_base', fallback=self.backoff_base)
+        self.backoff_max = config.getfloat('HTTP', 'backoff_max', fallback=self.backoff_max)
+        self.http_timeout = config.getfloat('HTTP', 'timeout', fallback=self.http_timeout)
+        self.pipeline_writers = config.getint('PIPELINE', 'writers', fallback=self.pipeline_writers)
+        self.pipeline_queue_size = config.getint('PIPELINE', 'queue_size', fallback=self.pipeline_queue_size)
+        max_dimensions = config.get('CRAWL', 'max_dimensions', fallback='')
+        self.max_dimensions = int(max_dimensions) if max_dimensions else None
+        self.session = build_session(config.getint('HTTP', 'pool_size', fallback=max(16, self.concurrency)))
+        if config.getboolean('CACHE', 'enabled', fallback=False):
+            self.cache = ResponseCache(
+                config.get('CACHE', 'path', fallback='.cache/ukcensus'),
+                max_size=config.getint('CACHE', 'max_size_mb', fallback=512) * 1024 * 1024,
+                ttls={kind: int(ttl) for kind, ttl in config.items('CACHE_TTL')} if config.has_section('CACHE_TTL') else None,
+            )
+
+    def cached_response(self, endpoint, params={}):
+        return self.cache.get(f"{self.base_url}/{endpoint}", params) if self.cache else None
 
     def make_request(self, endpoint, params={}):
-        elapsed_time = time.time() - self.start_time
-        print(f"Elapsed time: {elapsed_time}")  
-        print(f"Requests made: {self.requests_made}")
-        if elapsed_time < 10 and self.requests_made >= 80:
-            wait_time = 10 - elapsed_time
-            time.sleep(wait_time)
-            self.reset_timer()
+        cached = self.cached_response(endpoint, params)
+        if cached is not None and cached.fresh:
+            metrics.inc("ukcensus_cache_hits_total", endpoint=endpoint_kind(endpoint))
+            return cached.body
 
-        if elapsed_time < 60 and self.requests_made >= 180:
-            wait_time = 60 - elapsed_time
-            time.sleep(wait_time)
-            self.reset_timer()
+        log.debug("elapsed time %.1fs, requests made %d", time.time() - self.start_time, self.requests_made)
+        wait_time = self.limiter.acquire()
+        if wait_time > 0:
+            log.debug("waited %.2fs for rate limit", wait_time)
 
-        url = f"{self.base_url}/{endpoint}"
-        print(f"Making request to {url}")
-        response = requests.get(url, params=params)
         self.requests_made += 1
+        return self.send_request(endpoint, params=params, cached=cached)
+
+    def send_request(self, endpoint, params={}, cached=None):
+        """
+        cached -> stale cache entry to revalidate with If-None-Match and
+                  If-Modified-Since
+        """
+        url = f"{self.base_url}/{endpoint}"
+        kind = endpoint_kind(url)
+        log.debug("making request to %s", url)
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer("ukcensus_http_request_seconds", endpoint=kind):
+                    response = self.session.get(url, params=params, headers=headers, timeout=self.http_timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.inc("ukcensus_http_responses_total", endpoint=kind, status=type(e).__name__)
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            else:
+                metrics.inc("ukcensus_http_responses_total", endpoint=kind, status=response.status_code)
+                metrics.inc("ukcensus_http_response_bytes_total", len(response.content), endpoint=kind)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    break
+
+            wait_time = retry_delay(response, attempt, self.backoff_base, self.backoff_max)
+            log.warning("retrying %s in %.2fs (%d/%d)", url, wait_time, attempt + 1, self.max_retries)
+            metrics.inc("ukcensus_http_retry_sleep_seconds_total", wait_time, endpoint=kind)
+            time.sleep(wait_time)
+            self.limiter.acquire()
+            attempt += 1
+
+        if response.status_code == 304 and cached is not None:
+            self.cache.touch(cached, url)
+            return cached.body
 
         if response.status_code == 400:
-            print("400 error")
-            print(response.json())
+            log.warning("400 from %s: %s", url, response.text)
             return None
-        result = response.json()
+        if response.status_code != 200:
+            raise requests.HTTPError(f"Request to {response.url} failed with status code {response.status_code}",
+                                     response=response)
 
-        if response.status_code == 200:
-            return result
-        else:
-            raise Exception(f"Request failed with status code {response.status_code}")
+        result = response.json()
+        if self.cache:
+            self.cache.put(url, params, result, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return result
     
-    def fetch_all_data(self, endpoint, return_type="json", p={}):
-        limit = 100
-        offset = 0
-        total_count = -1
+    def iter_pages(self, endpoint, p={}, max_pages=None, parallel=None):
+        """
+        Yields the raw response of every page in order, None for a page the
+        API refused. In parallel mode at most [API] concurrency pages are
+        requested ahead of the consumer.
+        """
+        if max_pages is None:
+            max_pages = self.max_pages
+        if parallel is None:
+            parallel = self.parallel_pages
+
+        limit = self.page_size
+        response = self.make_request(endpoint, params={"limit": limit, "offset": 0, **p})
+        if response is None and limit > 100:
+            # endpoint does not accept the configured page size
+            limit = 100
+            response = self.make_request(endpoint, params={"limit": limit, "offset": 0, **p})
+        yield response
+        if response is None or "observations" in response:
+            return
+
+        total_count = response["total_count"]
+        offsets = range(limit, total_count, limit)
+        if max_pages:
+            offsets = offsets[:max_pages - 1]
+        log.debug("done fetching %s %d/%d", endpoint, limit, total_count)
+
+        def fetch_page(offset):
+            response = self.make_request(endpoint, params={"limit": limit, "offset": offset, **p})
+            if response is not None:
+                log.debug("done fetching %s %d/%d", endpoint, offset + limit, total_count)
+            return response
+
+        if not parallel or len(offsets) < 2:
+            for offset in offsets:
+                yield fetch_page(offset)
+            return
+
+        offsets = iter(offsets)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = deque(executor.submit(fetch_page, offset) for offset in islice(offsets, self.concurrency))
+            while pending:
+                page = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(fetch_page, offset))
+                yield page
+
+    def iter_data(self, endpoint, p={}, max_pages=None, parallel=None, by="page"):
+        """
+        Streams an endpoint instead of building the whole result set.
 
-        results = []
+        by -> "page" yields one list of items per page, "item" yields items
+        """
+        for response in self.iter_pages(endpoint, p=p, max_pages=max_pages, parallel=parallel):
+            if response is None:
+                log.warning("stopped fetching %s, page refused", endpoint)
+                return
+            items = response["observations"] if "observations" in response else response["items"]
+            if not items:
+                continue
+            if by == "item":
+                yield from items
+            else:
+                yield items
 
-        while total_count == -1 or offset < total_count:
-            params = {
-                "limit": limit,
-                "offset": offset,
-                **p
-            }
-            response = self.make_request(endpoint, params=params)
+    def fetch_all_data(self, endpoint, return_type="json", p={}, max_pages=None, parallel=None):
+        """
+        max_pages -> stop after this many pages, None to fetch all of them
+        parallel -> once total_count is known fetch the remaining pages
+                    concurrently, defaults to [API] parallel_pages
+        """
+        results = []
+        for response in self.iter_pages(endpoint, p=p, max_pages=max_pages, parallel=parallel):
             if response is None:
                 return []
-
             if "observations" in response:
                 results = response["observations"]
-                total_count = 1
                 break
-            
-            if total_count == -1:
-                total_count = response["total_count"]
-            
             if response["items"] is not None:
-                print(response["items"])
                 results.extend(response["items"])
-            
-            offset += limit
-
-            print(f"Done Fetching {endpoint} {offset}/{total_count}")
-
-            # TODO: Remove this
-            # if offset > limit:
-            #     break
 
-        
         if return_type == "df":
             return pd.DataFrame(results)
         return results
@@ -111,61 +266,109 @@ class RateLimitedAPI:
         self.start_time = time.time()
         self.requests_made = 0
 
+    @property
+    def storage(self):
+        """
+        PostgresStorage or SQLiteStorage as selected by [STORAGE] backend.
+        """
+        if self._storage is None:
+            if self.storage_backend == "sqlite":
+                self._storage = SQLiteStorage(self.storage_path)
+            else:
+                self._storage = PostgresStorage(
+                    minconn=self.db_min_connections,
+                    maxconn=self.db_max_connections,
+                    health_check_interval=self.db_health_check_interval,
+                    host=self.db_host, port=self.db_port, dbname=self.db_url,
+                    user=self.db_user, password=self.db_password or None,
+                )
+        return self._storage
+
+    @property
+    def db_pool(self):
+        return self.storage.pool
+
     def create_table_if_not_exists(self, table_name):
-        conn = psycopg2.connect(host=self.db_host, port=self.db_port, dbname=self.db_url, user=self.db_user)
-        cursor = conn.cursor()
+        self.storage.create_table(table_name)
 
-        create_query = """
-            CREATE TABLE IF NOT EXISTS "{}" (
-                id SERIAL PRIMARY KEY,
-                data JSONB
-            )
-            """.format(table_name)
+    def add_to_database(self,table_name, data):
+        self.storage.insert(table_name, data)
+    
 
-        cursor.execute(create_query)
-        conn.commit()
-        cursor.close()
-        conn.close()
+    def bulk_writer(self, table_name):
+        return self.storage.writer(table_name, batch_size=self.db_batch_size, flush_interval=self.db_flush_interval)
 
-    def add_to_database(self,table_name, data):
-        conn = psycopg2.connect(host=self.db_host, port=self.db_port, dbname=self.db_url, user=self.db_user)
-        cursor = conn.cursor()
+    def pipeline(self, table_name, store=None, on_error=None):
+        return Pipeline(self, table_name, writers=self.pipeline_writers, queue_size=self.pipeline_queue_size,
+                        store=store, on_error=on_error)
+
+    def area_batches(self, units, max_areas=None):
+        """
+        Packs per-area units into AreaBatches of at most [API] max_batch_areas
+        codes, see Batcher.batch_areas.
+        """
+        return batch_areas(units, self, self.max_url_length, max_areas or self.max_batch_areas)
 
-        insert_query = """
-            INSERT INTO "{}" (data) VALUES (%s)
-            """.format(table_name)
+    def estimate_crawl(self, units, estimate=None):
+        """
+        units -> (population_type, dimension_ids, area_type, area_code) as
+                 taken by CrawlManifest.enqueue
+        estimate -> CrawlEstimate the planner counted its skipped areas in
+        """
+        if estimate is None:
+            estimate = CrawlEstimate(self)
+        for batch in self.area_batches(units):
+            estimate.add(batch.endpoint(self), batch.dimension_ids, areas=len(batch))
+        return estimate.report()
 
-        json_data = json.dumps(data)
-        cursor.execute(insert_query, [json_data])
+    def warm_up_catalog(self, source="db", categorisations=False):
+        """
+        Loads the metadata into an in-memory catalog that the get_* lookups
+        answer from afterwards. See MetadataCatalog.warm_up.
+        """
+        self.catalog = MetadataCatalog().warm_up(self, source=source, categorisations=categorisations)
+        return self.catalog
 
-        conn.commit()
-        cursor.close()
-        conn.close()
-    
+    def observation_endpoint(self, population_type, area_type, area_code, dimension_id):
+        return 'population-types/{population_type}/census-observations?area-type={area_type},{area_code}&dimensions={dimestion_id}'\
+            '&limit={limit}'.format(population_type=population_type, dimestion_id=dimension_id, area_type=area_type, area_code=area_code, limit=1000)
 
     def get_results_from_database(self, select_query):
-        conn = psycopg2.connect(host=self.db_host, port=self.db_port, dbname=self.db_url, user=self.db_user)
-        cursor = conn.cursor()
-
-        cursor.execute(select_query)
-        results = cursor.fetchall()
+        return self.storage.query(select_query)
 
-        cursor.close()
-        conn.close()
+    def iter_batches_from_database(self, select_query, chunk_size=None):
+        """
+        Streams the results as Arrow record batches of at most chunk_size
+        rows, [DB] fetch_size by default.
+        """
+        return self.storage.iter_batches(select_query, chunk_size or self.db_fetch_size)
 
-        return pd.DataFrame(data=results, columns=[x[0] for x in cursor.description])
+    def get_table_from_database(self, select_query, return_type="polars", chunk_size=None):
+        """
+        return_type -> polars, arrow or pandas
+        """
+        table = pa.Table.from_batches(list(self.iter_batches_from_database(select_query, chunk_size)))
+        if return_type == "arrow":
+            return table
+        if return_type == "pandas":
+            return table.to_pandas()
+        return pl.from_arrow(table)
 
     def get_population_types(self, return_type="json"):
         endpoint = "population-types"
         self.create_table_if_not_exists("population-types")
         response = self.fetch_all_data(endpoint, return_type)
 
-        for item in response: 
-            self.add_to_database("population-types", item)
+        with self.bulk_writer("population-types") as writer:
+            writer.extend(response)
 
         return response
 
     def get_area_types(self, return_type="json", population_type=None) :
+        if self.catalog is not None:
+            response = self.catalog.area_types_frame(population_type)
+            if len(response) > 0:
+                return response
 
         areas_query = """
         SELECT data->>'id' as id FROM "area-types"
@@ -192,8 +395,8 @@ class RateLimitedAPI:
                 endpoint = "population-types/{population_type}/area-types".format(population_type=population_type)
                 response = self.fetch_all_data(endpoint, return_type)
                 response = [dict(item, **{'population-type':population_type}) for item in response]
-                for item in response:
-                    self.add_to_database("area-types", item)
+                with self.bulk_writer("area-types") as writer:
+                    writer.extend(response)
 
                 response = self.get_results_from_database(areas_query)
                 return response
@@ -205,12 +408,12 @@ class RateLimitedAPI:
 
             self.create_table_if_not_exists("area-types")
             
-            for _,name in response['name'].items():
-                endpoint = 'population-types/{population_type}/area-types'.format(population_type=name)
-                response = self.fetch_all_data(endpoint, return_type)
-                response = [dict(item, **{'population-type':name}) for item in response]
-                for item in response:
-                    self.add_to_database("area-types", item)
+            with self.bulk_writer("area-types") as writer:
+                for _,name in response['name'].items():
+                    endpoint = 'population-types/{population_type}/area-types'.format(population_type=name)
+                    response = self.fetch_all_data(endpoint, return_type)
+                    response = [dict(item, **{'population-type':name}) for item in response]
+                    writer.extend(response)
             
             response = self.get_results_from_database(areas_query)
         
@@ -249,11 +452,11 @@ class RateLimitedAPI:
 
             self.create_table_if_not_exists("area-infos")
             
-            for _,row in response.iterrows():
-                endpoint = 'population-types/{population_type}/area-types/{area_type}/areas'.format(population_type=row.population, area_type=row.id)
-                response = self.fetch_all_data(endpoint, return_type)
-                for item in response:
-                    self.add_to_database("area-infos", item)
+            with self.bulk_writer("area-infos") as writer:
+                for _,row in response.iterrows():
+                    endpoint = 'population-types/{population_type}/area-types/{area_type}/areas'.format(population_type=row.population, area_type=row.id)
+                    for page in self.iter_data(endpoint):
+                        writer.extend(page)
             
             response = self.get_results_from_database(areas_query)
         
@@ -288,13 +491,13 @@ class RateLimitedAPI:
 
         self.create_table_if_not_exists("dimensions")
         
-        for _,name in response['name'].items():
-            endpoint = 'population-types/{population_type}/dimensions'.format(population_type=name)
-            print(q_param)
-            response = self.fetch_all_data(endpoint, return_type, p={"q": q_param})
-            response = [dict(item, **{'population-type':name}) for item in response]
-            for item in response:
-                self.add_to_database("dimensions", item)
+        with self.bulk_writer("dimensions") as writer:
+            for _,name in response['name'].items():
+                endpoint = 'population-types/{population_type}/dimensions'.format(population_type=name)
+                log.debug("dimension query %s", q_param)
+                response = self.fetch_all_data(endpoint, return_type, p={"q": q_param})
+                response = [dict(item, **{'population-type':name}) for item in response]
+                writer.extend(response)
         
         # response = self.get_results_from_database(dimension_query)
         
@@ -318,6 +521,8 @@ class RateLimitedAPI:
 
 
     def get_categories(self,dimension_id = "hh_multi_religion"):
+        if self.catalog is not None and self.catalog.categorisations.get(dimension_id):
+            return pd.DataFrame({'data': self.catalog.categorisations[dimension_id]})
         select_categories = """
                 SELECT * from "categories" where data->>'dimension' = '{}'
                 """.format(dimension_id)
@@ -333,32 +538,58 @@ class RateLimitedAPI:
                         FROM "dimensions" where data->>'id' = '{}'
                     """.format(dimension_id)
             dimension = self.get_results_from_database(select_query)
-            for _, row in dimension.iterrows():
-                population = row.population
-                dimension_id = row.dimension
-                endpoint = '/population-types/{population_type}/' \
-                        '/dimensions/{dimension_id}/categorisations'\
-                            .format(population_type=population, dimension_id=dimension_id)
-                response = self.fetch_all_data(endpoint, return_type="json")
-                for item in response:
-                    self.add_to_database("categories", item)
+            with self.bulk_writer("categories") as writer:
+                for _, row in dimension.iterrows():
+                    population = row.population
+                    dimension_id = row.dimension
+                    endpoint = '/population-types/{population_type}/' \
+                            '/dimensions/{dimension_id}/categorisations'\
+                                .format(population_type=population, dimension_id=dimension_id)
+                    response = self.fetch_all_data(endpoint, return_type="json")
+                    response = [dict(item, **{'dimension': dimension_id, 'population-type': population}) for item in response]
+                    writer.extend(response)
         
         response = self.get_results_from_database(select_categories)
         return response
 
 
-    def get_data_final(self,return_type="json", dimension_id = "hh_multi_religion"):
+    def get_area_codes(self, population_type):
+        """
+        area_code, area_type of every area of the population's area types
+        """
+        if self.catalog is not None and population_type in self.catalog.area_types:
+            return self.catalog.area_codes_frame(population_type)
+
+        get_area_types = """
+        SELECT data->>'id' as area_type
+            FROM "area-types" where data->>'population-type' = '{}'
+        """.format(population_type)
+        area_types = self.get_results_from_database(get_area_types)['area_type'].to_list()
+
+        get_area_codes = """
+        SELECT data->>'id' as area_code, data->>'area_type' as area_type
+            FROM "area-infos" where data->>'area_type' IN ('{}')
+        """.format("','".join(area_types))
+        return self.get_results_from_database(get_area_codes)
+
+    def get_data_final(self,return_type="json", dimension_id = "hh_multi_religion", dry_run=False):
+        """
+        dry_run -> only report what the crawl would cost, see Estimate.CrawlEstimate
+        """
         data_query = """
-        SELECT * FROM "data_mt" where data->>'dimension_id' = '{}'
+        SELECT * FROM "data_mt" where data->>'dimension-id' = '{}'
         """.format(dimension_id)
 
         try:
+            # a dry run only estimates the crawl, the stored rows aren't needed
+            if dry_run:
+                raise UndefinedTable
             response = self.get_results_from_database(data_query)
-            if len(response) <1 :
+            if len(response) <1:
                 raise UndefinedTable
         except UndefinedTable:
-            endpoint = "data_mt"
-            self.create_table_if_not_exists("data_mt")
+            if not dry_run:
+                self.create_table_if_not_exists("data_mt")
 
             select_query = """
                 SELECT data->>'name' as population
@@ -368,113 +599,73 @@ class RateLimitedAPI:
 
             populations = self.get_results_from_database(select_query)
 
-            for _,row in populations.iterrows():
-                select_query = """
-                SELECT data->>'id' as dimension
-                  FROM "dimensions" where data->>'population-type' = '{}'
-                """.format(row.population)
-                dimension = self.get_results_from_database(select_query)
-
-                get_area_types = """
-                SELECT data->>'id' as area_type
-                    FROM "area-types" where data->>'population-type' = '{}'
-                """.format(row.population)
-                area_types = self.get_results_from_database(get_area_types)['area_type'].to_list()
-
-                get_area_codes = """
-                SELECT data->>'id' as area_code, data->>'area_type' as area_type
-                    FROM "area-infos" where data->>'area_type' = ANY(ARRAY['{}'])
-                """.format("','".join(area_types))
-                area_codes = self.get_results_from_database(get_area_codes)
-
-                for _, sub_row in dimension.iterrows():
-                    population_type = row.population
-                    dimension_id = sub_row.dimension
-                    for _, area in area_codes.iterrows():
-                        endpoint = 'population-types/{population_type}/census-observations?area-type={area_type},{area_code}&dimensions={dimestion_id}'\
-                            '&limit={limit}'.format(population_type=population_type, dimestion_id=dimension_id, area_type=area.area_type, area_code=area.area_code, limit=1000)
-                        response = self.fetch_all_data(endpoint, return_type, p={})
-                        response = [dict(item, **{'population-type':population_type, 'dimension-id': dimension_id}) for item in response]
-                        for item in response:
-                            self.add_to_database("data_mt", item)
+            def observation_units():
+                for _,row in populations.iterrows():
+                    if self.catalog is not None and row.population in self.catalog.dimensions:
+                        dimension = pd.DataFrame({'dimension': self.catalog.dimensions[row.population].keys})
+                    else:
+                        select_query = """
+                        SELECT data->>'id' as dimension
+                          FROM "dimensions" where data->>'population-type' = '{}'
+                        """.format(row.population)
+                        dimension = self.get_results_from_database(select_query)
+
+                    area_codes = self.get_area_codes(row.population)
+
+                    for _, sub_row in dimension.iterrows():
+                        population_type = row.population
+                        dimension_id = sub_row.dimension
+                        for _, area in area_codes.iterrows():
+                            yield population_type, [dimension_id], area.area_type, area.area_code
+
+            if dry_run:
+                return self.estimate_crawl(observation_units())
+
+            self.pipeline("data_mt").run(batch.unit(self) for batch in self.area_batches(observation_units()))
             
             response = self.get_results_from_database(data_query)
         
         return response
 
 
-    def get_multi_final_data(self, population_type,return_type="json", dimension = [], how="all",n=1):
+    def get_multi_final_data(self, population_type,return_type="json", dimension = [], how="all",n=None, dry_run=False):
         """
-        how -> all or any
-        n -> number of dimensions to be taken at a time
+        how -> all or any, see utils.generate_subsets
+        n -> number of dimensions to be taken at a time, one per list in dimension by default
+        dry_run -> only report what the crawl would cost, see Estimate.CrawlEstimate
         """
-        data_query = """
-                SELECT distinct(data->>'dimension-id') as dimensions_present
-                FROM "data_mt" where data->>'population-type' = '{}'
-            """.format(population_type)
-        dimension_data = self.get_results_from_database(data_query)
-        dimension_data = dimension_data['dimensions_present'].apply(literal_eval).to_list()
-
         # except (UndefinedTable, TypeError) as e:
-        endpoint = "data_mt"
-        self.create_table_if_not_exists("data_mt")
+        if how not in ("any", "all"):
+            raise ValueError("how can only be any or all")
+        dimensions = generate_subsets(dimension, how=how, n=n, max_dimensions=self.max_dimensions)
 
-        get_area_types = """
-        SELECT data->>'id' as area_type
-            FROM "area-types" where data->>'population-type' = '{}'
-        """.format(population_type)
-        area_types = self.get_results_from_database(get_area_types)['area_type'].to_list()
+        if not dry_run:
+            self.create_table_if_not_exists("data_mt")
+        fetched = FetchedIndex.from_store(self, population_type, "data_mt")
+        estimate = CrawlEstimate(self)
+
+        area_codes = self.get_area_codes(population_type)
 
-        get_area_codes = """
-        SELECT data->>'id' as area_code, data->>'area_type' as area_type
-            FROM "area-infos" where data->>'area_type' = ANY(ARRAY['{}'])
-        """.format("','".join(area_types))
-        area_codes = self.get_results_from_database(get_area_codes)
-
-        dimensions = []
-        if how == "any":
-            # make all powerset of all sets of length n 
-            dimensions.extend(generate_subsets(dimension))
-        elif how == "all":
-            dimensions = dimension[0]
-        else:
-            raise ValueError("how can only be any or all")
         
         dimensions = [['religion_tb','resident_age_8a']]
 
-        data = RateLimitedAPI().get_dimensional_data(dimension_id=['religion_tb','resident_age_8a'],population_type='UR')
-        #split pandas column to multiple columns json
-        column = "data"
-        data = json_normalize(data[column].tolist()).add_prefix(f"{column}.")
-
-        column = "data.dimensions"
-        data = json_normalize(data[column]).add_prefix(f"{column}.")
-        data = data.rename(columns={'data.dimensions.0': 'area_info', 'data.dimensions.1': 'age_info', 'data.dimensions.2': 'religion_info'})
-        column = "area_info"
-        area_info = json_normalize(data[column].tolist()).add_prefix(f"{column}.")
-
-        for dimension_id in dimensions:
-            # check if data is already present in database
-            print("checking for dimension {}".format(dimension_id))
-            if list(dimension_id) in dimension_data:
-                print("data already present for dimension {}".format(dimension_id))
-            for _, area in area_codes[area_codes['area_type']=='lsoa'].iterrows():
-                # filtered_data = area_info.query(
-                #     "area_info.option_id == '{}' and area_info.dimension_id == '{}'".format(area.area_type, area.area_code)
-                # )
-                filtered_data = area_info[(area_info['area_info.dimension_id'] == area.area_type) & (area_info['area_info.option_id']== area.area_code)]
-                if not filtered_data.empty:
-                    print("data already present for dimension {} and area {} : {}".format(dimension_id,area.area_type ,area.area_code))
-                    continue
-                
-                endpoint = 'population-types/{population_type}/census-observations?area-type={area_type},{area_code}&dimensions={dimestion_id}'\
-                    '&limit={limit}'.format(population_type=population_type, dimestion_id=','.join(list(dimension_id)), area_type=area.area_type, area_code=area.area_code, limit=1000)
-                response = self.fetch_all_data(endpoint, return_type, p={})
-                if not response:
-                    continue
-                response = [dict(item, **{'population-type':population_type, 'dimension-id': list(dimension_id)}) for item in response]
-                for item in response:
-                    self.add_to_database("data_mt", item)
+        def observation_units():
+            for dimension_id in dimensions:
+                # check if data is already present in database
+                log.debug("checking for dimension %s", dimension_id)
+                for _, area in area_codes[area_codes['area_type']=='lsoa'].iterrows():
+                    if fetched.has(dimension_id, area.area_type, area.area_code):
+                        estimate.skip()
+                        log.debug("data already present for dimension %s and area %s : %s", dimension_id, area.area_type, area.area_code)
+                        continue
+
+                    yield population_type, list(dimension_id), area.area_type, area.area_code
+
+        if dry_run:
+            return self.estimate_crawl(observation_units(), estimate)
+
+        units = (batch.unit(self) for batch in self.area_batches(observation_units()))
+        self.pipeline("data_mt", store=fetched.track(buffer_items)).run(units)
         # response = self.get_results_from_database(data_query)
         
         return 
@@ -485,9 +676,13 @@ class RateLimitedAPI:
         """
         filter -> string to be filtered
         """
+        if self.catalog is not None and population_type in self.catalog.dimensions:
+            response = self.catalog.find_dimensions(population_type, _filter)
+            return response if return_type == "list" else pd.DataFrame({'dimension': response})
+
         select_query = """
             SELECT data->>'id' as dimension
-              FROM "dimensions" where  data->>'id' like '%\{}%'
+              FROM "dimensions" where  data->>'id' like '%\{}%' ESCAPE '\\'
               AND data->>'population-type' = '{}'
             """.format(_filter,population_type)
         response = self.get_results_from_database(select_query)
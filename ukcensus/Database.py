@@ -0,0 +1,151 @@
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extras
+import pyarrow as pa
+from psycopg2.pool import ThreadedConnectionPool
+
+# Arrow types for the postgres type oids the cache tables use, json and
+# jsonb are kept as their text so every batch has the same schema
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(), 21: pa.int64(), 23: pa.int64(),
+    700: pa.float64(), 701: pa.float64(),
+    25: pa.string(), 1043: pa.string(),
+    114: pa.string(), 3802: pa.string(),
+    1009: pa.list_(pa.string()), 1015: pa.list_(pa.string()),
+    1114: pa.timestamp('us'), 1184: pa.timestamp('us', tz='UTC'),
+}
+
+_cursor_names = itertools.count()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    minconn, maxconn -> pool bounds, checkout blocks while all maxconn are busy
+    health_check_interval -> connections idle longer than this many seconds
+                             are pinged before being handed out
+    connect_kwargs -> passed through to psycopg2.connect
+    """
+
+    def __init__(self, minconn=1, maxconn=10, health_check_interval=30, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+        self.connect_kwargs = connect_kwargs
+        self.pid = os.getpid()
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.last_used = {}
+        self.prepared = {}
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+
+    def healthy(self, conn):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        idle = now - self.last_used.get(id(conn), now)
+        if idle < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        conn = self.pool.getconn()
+        while not self.healthy(conn):
+            self.last_used.pop(id(conn), None)
+            self.prepared.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+            conn = self.pool.getconn()
+        return conn
+
+    def putconn(self, conn):
+        self.last_used[id(conn)] = time.monotonic()
+        self.pool.putconn(conn, close=bool(conn.closed))
+        # connections above minconn are closed on the way back in
+        if conn.closed:
+            self.last_used.pop(id(conn), None)
+            self.prepared.pop(id(conn), None)
+
+    def statements(self, conn):
+        """
+        Names of the statements prepared on conn, they last as long as the
+        connection does.
+        """
+        return self.prepared.setdefault(id(conn), set())
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection, commits on success and rolls back on error.
+        """
+        self.slots.acquire()
+        try:
+            conn = self.getconn()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.putconn(conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.pool.closeall()
+        self.last_used.clear()
+        self.prepared.clear()
+
+
+def arrow_column(values, arrow_type):
+    if arrow_type is None:
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+    return pa.array(values, type=arrow_type)
+
+
+def stream_query(pool, select_query, chunk_size=10000, params=None):
+    """
+    Runs select_query through a named server-side cursor and yields Arrow
+    record batches of at most chunk_size rows, so only one chunk is held in
+    Python at a time. A query without rows yields one empty batch.
+
+    params -> values of the %s placeholders of select_query
+
+    json and jsonb columns come back as their text, columns of other types
+    not in ARROW_TYPES as strings.
+    """
+    with pool.connection() as conn:
+        with conn.cursor(name="stream_{}".format(next(_cursor_names))) as cursor:
+            cursor.itersize = chunk_size
+            psycopg2.extras.register_default_json(cursor, loads=lambda text: text)
+            psycopg2.extras.register_default_jsonb(cursor, loads=lambda text: text)
+            cursor.execute(select_query, params)
+
+            types = None
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if types is None:
+                    types = [(column.name, ARROW_TYPES.get(column.type_code)) for column in cursor.description]
+                    schema = pa.schema([(name, arrow_type or pa.string()) for name, arrow_type in types])
+                elif not rows:
+                    return
+
+                columns = list(zip(*rows)) if rows else [()] * len(types)
+                yield pa.record_batch(
+                    [arrow_column(values, arrow_type) for values, (_, arrow_type) in zip(columns, types)], schema=schema
+                )
+                if len(rows) < chunk_size:
+                    return
@@ -0,0 +1,90 @@
+import math
+from collections import Counter
+
+from ukcensus.Metrics import log
+from ukcensus.Schema import dimension_key
+
+
+def crawl_seconds(requests, windows, interval=0):
+    """
+    Least time to send requests through a RateLimiter with these windows
+    and pacing interval, starting from an unused budget.
+    """
+    if requests <= 0:
+        return 0.0
+    seconds = (requests - 1) * interval
+    for limit, period in windows:
+        seconds = max(seconds, (math.ceil(requests / limit) - 1) * period)
+    return seconds
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return "{}d {}h".format(days, hours)
+    if hours:
+        return "{}h {}m".format(hours, minutes)
+    return "{}m {}s".format(minutes, seconds)
+
+
+class CrawlEstimate:
+    """
+    Counts what a crawl plan would cost without sending anything: the
+    observation requests, how many of them the response cache would
+    answer, and the time the rest take under the api limiter. Areas the
+    planner skipped because the store already has them are counted apart
+    through skip.
+
+    Areas are counted in the AreaBatches the crawl would send. The estimate
+    assumes no other process is drawing from the same rate limit file.
+
+    api -> RateLimitedAPI whose cache and limiter the crawl would use
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.units = 0
+        self.areas = 0
+        self.cached = 0
+        self.stored = 0
+        self.combinations = Counter()
+
+    def add(self, endpoint, dimension_ids, areas=1):
+        self.units += 1
+        self.areas += areas
+        self.combinations[dimension_key(dimension_ids)] += 1
+        if self.api.cache is not None and self.api.cache.is_fresh(f"{self.api.base_url}/{endpoint}"):
+            self.cached += 1
+
+    def skip(self, areas=1):
+        self.stored += areas
+
+    @property
+    def requests(self):
+        return self.units - self.cached
+
+    def seconds(self):
+        limiter = self.api.limiter
+        return crawl_seconds(self.requests, limiter.windows, limiter.interval)
+
+    def report(self, top=10):
+        rate = min(limit / period for limit, period in self.api.limiter.windows)
+        log.info("dry run: %s observation requests planned for %s areas, %s cached, %s to send",
+                 self.units, self.areas, self.cached, self.requests)
+        log.info("%s areas already stored", self.stored)
+        log.info("estimated time at %.1f requests/s: %s", rate, format_duration(self.seconds()))
+        if self.combinations:
+            log.info("largest combinations:")
+            for key, count in self.combinations.most_common(top):
+                log.info("  %s: %s requests", key, count)
+        return {
+            'units': self.units,
+            'areas': self.areas,
+            'cached': self.cached,
+            'stored': self.stored,
+            'requests': self.requests,
+            'seconds': self.seconds(),
+            'combinations': dict(self.combinations),
+        }
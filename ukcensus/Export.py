@@ -0,0 +1,125 @@
+import argparse
+import json
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import polars as pl
+
+from ukcensus.Metrics import log
+from ukcensus.Observations import flatten_observations
+from ukcensus.Query import Query
+from ukcensus.Schema import dimension_key
+
+PARTITION_COLUMNS = ("population_type", "dimension_key", "area_type")
+
+
+def observation_query(source, population_type=None, dimension_ids=None):
+    """
+    Query for the observations of source, data_mt style JSONB rows or the
+    typed observations table, optionally narrowed to one population type
+    and dimension combination.
+    """
+    if source == "observations":
+        query = Query("observations").select("population_type", "area_type", "area_code", "dimension_ids",
+                                             "option_ids", "observation")
+        if population_type:
+            query.where("population_type", population_type)
+        if dimension_ids:
+            query.where("dimension_key", dimension_key(dimension_ids))
+        return query
+
+    query = Query(source).select("data")
+    if population_type:
+        query.where("data->>'population-type'", population_type)
+    if dimension_ids:
+        # the tag is a plain id for single dimensions and a list in crawl order
+        # otherwise, which sqlite renders without spaces
+        tags = {json.dumps(ids, separators=separators) for ids in (list(dimension_ids), sorted(dimension_ids))
+                for separators in ((', ', ': '), (',', ':'))}
+        if len(dimension_ids) == 1:
+            tags.add(dimension_ids[0])
+        query.where_in("data->>'dimension-id'", sorted(tags))
+    return query
+
+
+def typed_records(batch):
+    """
+    Rows of the typed observations table as census-observations records.
+    """
+    for row in batch.to_pylist():
+        dimensions = [{'dimension_id': row['area_type'], 'option_id': row['area_code']}]
+        dimensions.extend({'dimension_id': dimension_id, 'option_id': option_id}
+                          for dimension_id, option_id in zip(row['dimension_ids'], row['option_ids']))
+        yield {'population-type': row['population_type'], 'dimension-id': row['dimension_ids'],
+               'dimensions': dimensions, 'observation': row['observation']}
+
+
+def export_observations(api, path, population_type=None, dimension_ids=None, source=None,
+                        partition_by=PARTITION_COLUMNS, compression="zstd", chunk_size=100000,
+                        max_rows_per_group=100000):
+    """
+    Writes observations as a Hive-partitioned Parquet dataset under path,
+    e.g. path/population_type=UR/dimension_key=religion_tb/area_type=lsoa/.
+    Every chunk is flattened with flatten_observations, deduplicated and
+    sorted by area code so the row group statistics prune well; each
+    dimension combination keeps its own dimension columns.
+
+    Partitions the export writes to are emptied the first time it writes
+    to them, so a re-export replaces their files; other partitions are left
+    alone. Rows are only deduplicated within a chunk, an observation stored
+    twice in the source can appear twice in the dataset if its copies are
+    read in different chunks.
+
+    source -> table to read, [DB] observation_schema's table by default
+    partition_by -> columns turned into directories
+    compression -> parquet codec
+    chunk_size -> rows read from the database at a time
+    """
+    source = source or api.observation_table
+    select_query = observation_query(source, population_type, dimension_ids)
+    file_options = ds.ParquetFileFormat().make_write_options(compression=compression, write_statistics=True)
+
+    rows = 0
+    written = set()
+    for chunk, batch in enumerate(api.iter_batches_from_database(select_query, chunk_size)):
+        if batch.num_rows == 0:
+            continue
+        if source == "observations":
+            records = typed_records(batch)
+        else:
+            records = (json.loads(text) for text in batch.column('data').to_pylist())
+        data = flatten_observations(records, labels=source != "observations").unique()
+
+        for part, key in enumerate(data['dimension_key'].unique().sort().to_list()):
+            group = data.filter(pl.col('dimension_key') == key).sort('area_code')
+            group = group.select([column for column in group.columns
+                                  if column in partition_by or group[column].null_count() < len(group)])
+            for partition, frame in group.partition_by(list(partition_by), as_dict=True, maintain_order=True).items():
+                table = frame.to_arrow()
+                ds.write_dataset(
+                    table, path, format="parquet", file_options=file_options,
+                    partitioning=ds.partitioning(pa.schema([table.schema.field(column) for column in partition_by]), flavor="hive"),
+                    basename_template="part-{}-{}-{{i}}.parquet".format(chunk, part),
+                    existing_data_behavior="overwrite_or_ignore" if partition in written else "delete_matching",
+                    max_rows_per_group=max_rows_per_group, min_rows_per_group=min(max_rows_per_group, len(table)),
+                )
+                written.add(partition)
+                rows += len(table)
+        log.info("exported %s rows to %s", rows, path)
+    return rows
+
+
+if __name__ == "__main__":
+    from ukcensus.CensusData import RateLimitedAPI
+
+    parser = argparse.ArgumentParser(description="Export census observations as a partitioned Parquet dataset")
+    parser.add_argument("path", help="directory the dataset is written to")
+    parser.add_argument("--population-type", help="only export this population type")
+    parser.add_argument("--dimensions", nargs="*", help="only export this dimension combination")
+    parser.add_argument("--source", help="table to export, the configured observation table by default")
+    parser.add_argument("--partition-by", nargs="*", default=list(PARTITION_COLUMNS))
+    parser.add_argument("--compression", default="zstd")
+    args = parser.parse_args()
+
+    export_observations(RateLimitedAPI(), args.path, population_type=args.population_type, dimension_ids=args.dimensions,
+                        source=args.source, partition_by=args.partition_by, compression=args.compression)
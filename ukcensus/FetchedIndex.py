@@ -0,0 +1,83 @@
+import threading
+
+from psycopg2.errors import UndefinedTable
+
+from ukcensus.Query import Query
+from ukcensus.Schema import dimension_key, observation_row, parse_dimension_tag
+
+
+class FetchedIndex:
+    """
+    Set of (dimension key, area type, area code) already in the store, so
+    the crawl skip checks are a hash lookup instead of a scan.
+
+    Built once per crawl with from_store, then kept current by wrapping the
+    pipeline store hook with track.
+    """
+
+    def __init__(self, pairs=()):
+        self.lock = threading.Lock()
+        self.pairs = set(pairs)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def has(self, dimension_ids, area_type, area_code):
+        return (dimension_key(dimension_ids), area_type, area_code) in self.pairs
+
+    def add(self, dimension_ids, area_type, area_code):
+        with self.lock:
+            self.pairs.add((dimension_key(dimension_ids), area_type, area_code))
+
+    def add_items(self, items):
+        pairs = set()
+        for item in items:
+            _, area_type, area_code, key = observation_row(item)[:4]
+            pairs.add((key, area_type, area_code))
+        with self.lock:
+            self.pairs.update(pairs)
+
+    def track(self, store):
+        """
+        Wraps a Pipeline store hook so stored rows are added to the index.
+        """
+        def tracked(writer, unit, items):
+            store(writer, unit, items)
+            self.add_items(items)
+        return tracked
+
+    @classmethod
+    def from_store(cls, api, population_type, table_name="data_mt"):
+        """
+        Loads the pairs stored for population_type in table_name plus the
+        units the crawl manifest has marked done. The API lists the area
+        first in every observation, so in data_mt it is read from the first
+        dimension, where Schema.observation_area also finds it.
+        """
+        index = cls()
+        queries = [Query("crawl_manifest").distinct().select("dimension_key", "area_type", "area_code")
+                   .where("status", "done").where("population_type", population_type)]
+        if table_name == "observations":
+            queries.append(Query("observations").distinct().select("dimension_key", "area_type", "area_code")
+                           .where("population_type", population_type))
+
+        for query in queries:
+            try:
+                response = api.run_query(query)
+            except UndefinedTable:
+                continue
+            index.pairs.update(zip(response['dimension_key'], response['area_type'], response['area_code']))
+
+        if table_name != "observations":
+            query = Query(table_name).distinct().select(
+                tag="data->>'dimension-id'",
+                area_type="data->'dimensions'->0->>'dimension_id'",
+                area_code="data->'dimensions'->0->>'option_id'",
+            ).where("data->>'population-type'", population_type)
+            try:
+                response = api.run_query(query)
+            except UndefinedTable:
+                return index
+            keys = response['tag'].map(lambda tag: dimension_key(parse_dimension_tag(tag)))
+            index.pairs.update(zip(keys, response['area_type'], response['area_code']))
+        return index
@@ -0,0 +1,52 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def build_session(pool_size=16):
+    """
+    Keep-alive session with a connection pool sized for pool_size threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+def retry_after(response):
+    """
+    Seconds asked for by the Retry-After header, None if absent or unreadable.
+    """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(response, attempt, backoff_base=1, backoff_max=60):
+    """
+    Full-jitter exponential backoff, never shorter than Retry-After.
+    """
+    delay = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+    asked = retry_after(response)
+    if asked is not None:
+        delay = max(delay, asked)
+    return delay
@@ -0,0 +1,204 @@
+import os
+import socket
+import time
+import uuid
+from itertools import chain
+
+from psycopg2.extras import execute_values
+
+from ukcensus.Metrics import log, metrics
+from ukcensus.Schema import dimension_key
+
+CREATE_MANIFEST = """
+    CREATE TABLE IF NOT EXISTS "crawl_manifest" (
+        id BIGSERIAL PRIMARY KEY,
+        population_type TEXT NOT NULL,
+        dimension_key TEXT NOT NULL,
+        dimension_ids TEXT[] NOT NULL,
+        area_type TEXT NOT NULL,
+        area_code TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        row_count INTEGER,
+        claimed_by TEXT,
+        error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        UNIQUE (population_type, dimension_key, area_type, area_code)
+    );
+    CREATE INDEX IF NOT EXISTS "crawl_manifest_status_idx" ON "crawl_manifest" (status, id);
+    ALTER TABLE "crawl_manifest" ADD COLUMN IF NOT EXISTS crawl_id TEXT;
+    CREATE INDEX IF NOT EXISTS "crawl_manifest_crawl_idx" ON "crawl_manifest" (crawl_id, status, id);
+    """
+
+
+class CrawlManifest:
+    """
+    Persistent work queue of observation requests, one row per
+    (population type, dimension combination, area type, area code).
+
+    Rows go pending -> running -> done, or failed with the last error.
+    Workers claim rows with FOR UPDATE SKIP LOCKED, so any number of them
+    can share the queue, and a row is marked done in the same transaction
+    that writes its observations. Each manifest only claims the rows it
+    enqueued itself, tagged with its crawl_id; enqueueing a unit another
+    crawl left unfinished moves it to this one.
+
+    api -> RateLimitedAPI whose pool holds the manifest
+    stale_after -> seconds after which a running row is assumed abandoned
+    max_attempts -> failed rows are retried until they reach this
+    crawl_id -> tag of the rows this manifest enqueues and claims, a new
+                one by default
+    """
+
+    def __init__(self, api, stale_after=600, max_attempts=3, crawl_id=None):
+        self.api = api
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.crawl_id = crawl_id or uuid.uuid4().hex
+
+    def create(self):
+        with self.api.db_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(CREATE_MANIFEST)
+
+    def enqueue(self, units, page_size=1000):
+        """
+        units -> iterable of (population_type, dimension_ids, area_type, area_code),
+                 combinations already in the manifest keep their status and
+                 are only moved to this crawl when not done
+        """
+        rows = ((population_type, dimension_key(dimension_ids), list(dimension_ids), area_type, area_code, self.crawl_id)
+                for population_type, dimension_ids, area_type, area_code in units)
+        with self.api.db_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO "crawl_manifest" (population_type, dimension_key, dimension_ids, area_type, area_code, crawl_id)
+                    VALUES %s
+                    ON CONFLICT (population_type, dimension_key, area_type, area_code)
+                    DO UPDATE SET crawl_id = EXCLUDED.crawl_id WHERE "crawl_manifest".status <> 'done'
+                    """, rows, page_size=page_size)
+
+    def claim(self, limit=100):
+        """
+        Claimed rows grouped by request, so batch_areas can pack the areas
+        of each request together; RETURNING alone comes back in heap order.
+        """
+        with self.api.db_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    WITH claimed AS (
+                        UPDATE "crawl_manifest"
+                           SET status = 'running', attempts = attempts + 1, claimed_by = %s, updated_at = now()
+                         WHERE id IN (
+                            SELECT id FROM "crawl_manifest"
+                             WHERE crawl_id = %s
+                               AND (status = 'pending'
+                                    OR (status = 'running' AND updated_at < now() - make_interval(secs => %s))
+                                    OR (status = 'failed' AND attempts < %s))
+                             ORDER BY id
+                             LIMIT %s
+                               FOR UPDATE SKIP LOCKED
+                         )
+                        RETURNING id, population_type, dimension_key, dimension_ids, area_type, area_code, attempts
+                    )
+                    SELECT id, population_type, dimension_ids, area_type, area_code, attempts FROM claimed
+                     ORDER BY population_type, dimension_key, area_type, id
+                    """, [self.worker, self.crawl_id, self.stale_after, self.max_attempts, limit])
+                return cursor.fetchall()
+
+    def store(self, writer, unit, items):
+        """
+        Pipeline store hook: writes the unit's observations and marks each
+        of its areas done, with its own row count, in one transaction.
+
+        Only areas this worker still holds are written: an area reclaimed as
+        stale by another worker is left to that worker, and its rows dropped.
+        """
+        batch = unit[2]
+        rows = batch.rows_per_area(items)
+        with metrics.timer("ukcensus_db_seconds", operation="write", table=writer.table_name), \
+                self.api.db_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                done = execute_values(cursor, """
+                    UPDATE "crawl_manifest" SET status = 'done', row_count = v.row_count, error = NULL, updated_at = now()
+                      FROM (VALUES %s) AS v (id, row_count, claimed_by)
+                     WHERE "crawl_manifest".id = v.id AND "crawl_manifest".claimed_by = v.claimed_by
+                       AND "crawl_manifest".status = 'running'
+                 RETURNING "crawl_manifest".id
+                    """, [(manifest_id, rows[area_code], self.worker) for area_code, manifest_id in batch.areas],
+                    fetch=True)
+                if len(done) < len(batch.areas):
+                    done = {manifest_id for manifest_id, in done}
+                    held = {area_code for area_code, manifest_id in batch.areas if manifest_id in done}
+                    log.warning("%s %s areas of %s %s were reclaimed by another worker, not storing them",
+                                len(batch.areas) - len(held), batch.area_type, batch.population_type,
+                                ",".join(batch.dimension_ids))
+                    items = [item for item in items if batch.area_code(item) in held]
+                if items:
+                    writer.copy(cursor, items)
+        with writer.lock:
+            writer.rows_written += len(items)
+        metrics.inc("ukcensus_db_rows_written_total", len(items), table=writer.table_name)
+
+    def fail(self, unit, error):
+        with self.api.db_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE "crawl_manifest" SET status = 'failed', error = %s, updated_at = now()
+                     WHERE id = ANY(%s) AND claimed_by = %s AND status = 'running'
+                    """, [str(error), [manifest_id for _, manifest_id in unit[2].areas], self.worker])
+
+    def touch(self, ids):
+        """
+        Refreshes updated_at of the rows in ids this worker still holds, so
+        they aren't reclaimed as stale while it works through them.
+        """
+        with self.api.db_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE "crawl_manifest" SET updated_at = now()
+                     WHERE id = ANY(%s) AND claimed_by = %s AND status = 'running'
+                    """, [ids, self.worker])
+
+    def units(self, batch_size=100):
+        """
+        Claims work batch by batch and yields it as AsyncCrawler units
+        (endpoint, tags, AreaBatch) until the queue is drained. Rows being
+        retried are requested one area at a time.
+
+        A claim can take longer than stale_after to send under the shared
+        rate limit, so its rows are touched every quarter of stale_after
+        while units are still being handed out.
+        """
+        while True:
+            claimed = self.claim(batch_size)
+            if not claimed:
+                return
+            ids = [row[0] for row in claimed]
+            touched = time.time()
+            first = [(pop, ids, area_type, area_code, manifest_id)
+                     for manifest_id, pop, ids, area_type, area_code, attempts in claimed if attempts == 1]
+            retried = [(pop, ids, area_type, area_code, manifest_id)
+                       for manifest_id, pop, ids, area_type, area_code, attempts in claimed if attempts > 1]
+            for batch in chain(self.api.area_batches(first), self.api.area_batches(retried, max_areas=1)):
+                if time.time() - touched > self.stale_after / 4:
+                    self.touch(ids)
+                    touched = time.time()
+                yield batch.unit(self.api)
+
+    def run(self, table_name, batch_size=100, index=None):
+        """
+        Works through the queue, writing observations to table_name.
+
+        index -> FetchedIndex kept current as the rows land
+        """
+        store = self.store if index is None else index.track(self.store)
+        pipeline = self.api.pipeline(table_name, store=store, on_error=self.fail)
+        return pipeline.run(self.units(batch_size))
+
+    def status(self):
+        return self.api.get_results_from_database("""
+            SELECT status, count(*) as units, sum(row_count) as rows FROM "crawl_manifest" GROUP BY status
+            """)
@@ -0,0 +1,192 @@
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger("ukcensus")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "ukcensus_http_request_seconds": ("histogram", "Latency of each API call, retries counted separately"),
+    "ukcensus_http_responses_total": ("counter", "API responses by status code"),
+    "ukcensus_http_response_bytes_total": ("counter", "Decoded bytes of API response bodies"),
+    "ukcensus_http_retry_sleep_seconds_total": ("counter", "Seconds slept backing off before retries"),
+    "ukcensus_cache_hits_total": ("counter", "Requests answered from the response cache"),
+    "ukcensus_ratelimit_sleep_seconds_total": ("counter", "Seconds waited for a rate limiter slot"),
+    "ukcensus_db_seconds": ("histogram", "Duration of database operations"),
+    "ukcensus_db_rows_written_total": ("counter", "Rows written to the database"),
+}
+
+
+def configure_logging(level="INFO"):
+    """
+    Sends the ukcensus log to stderr at level, the verbose per-request
+    lines are logged at DEBUG.
+    """
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    log.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def state(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    def merge(self, state):
+        for i, count in enumerate(state["counts"]):
+            self.counts[i] += count
+        self.sum += state["sum"]
+        self.count += state["count"]
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Metrics:
+    """
+    In-process counters and histograms, keyed on a metric name plus labels.
+    Exported as a JSON snapshot or in the Prometheus text format; snapshots
+    from worker processes can be merged back in.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self, reset=False):
+        """
+        Every metric as JSON-ready dicts, reset clears them afterwards so
+        the next snapshot only holds what happened since.
+        """
+        with self.lock:
+            snapshot = {
+                "started": self.started,
+                "taken": time.time(),
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "histograms": [dict(histogram.state(), name=name, labels=dict(labels))
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+            if reset:
+                self.counters.clear()
+                self.histograms.clear()
+                self.started = snapshot["taken"]
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for counter in snapshot["counters"]:
+                key = (counter["name"], label_key(counter["labels"]))
+                self.counters[key] = self.counters.get(key, 0) + counter["value"]
+            for state in snapshot["histograms"]:
+                key = (state["name"], label_key(state["labels"]))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(state["buckets"])
+                histogram.merge(state)
+
+    def to_json(self, path=None):
+        text = json.dumps(self.snapshot(), indent=2)
+        if path:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    def to_prometheus(self, path=None):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        series = {}
+        for counter in snapshot["counters"]:
+            series.setdefault(counter["name"], []).append(
+                (counter["name"], counter["labels"], counter["value"]))
+        for state in snapshot["histograms"]:
+            samples = series.setdefault(state["name"], [])
+            cumulative = 0
+            for bound, count in zip(list(state["buckets"]) + [math.inf], state["counts"]):
+                cumulative += count
+                samples.append((state["name"] + "_bucket", dict(state["labels"], le=format_value(bound)), cumulative))
+            samples.append((state["name"] + "_sum", state["labels"], state["sum"]))
+            samples.append((state["name"] + "_count", state["labels"], state["count"]))
+
+        lines = []
+        for name in sorted(series):
+            kind, text = HELP.get(name, ("untyped", name))
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for sample, labels, value in series[name]:
+                lines.append("{}{} {}".format(sample, format_labels(labels), format_value(value)))
+        text = "\n".join(lines) + "\n"
+        if path:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    def write(self, path):
+        """
+        Writes the Prometheus text for .prom paths, the JSON snapshot otherwise.
+        """
+        if path.endswith(".prom"):
+            return self.to_prometheus(path)
+        return self.to_json(path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for name, value in sorted(labels.items())) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+metrics = Metrics()
@@ -0,0 +1,57 @@
+import pyarrow as pa
+import polars as pl
+
+from ukcensus.Schema import dimension_key, observation_area
+
+
+def flatten_observations(records, labels=True, return_type="polars"):
+    """
+    Turns observation records into one row per observation in a single
+    pass, with the area in area_type / area_code / area and every other
+    dimension in a column named by its dimension_id holding the option_id.
+    dimension_key names the combination the row belongs to.
+
+    records -> census-observations items or data_mt `data` values
+    labels -> also add a <dimension_id>_label column with the option names
+    return_type -> polars, arrow or pandas
+    """
+    columns = {'population_type': [], 'dimension_key': [], 'area_type': [], 'area_code': [], 'area': []}
+    observations = []
+    rows = 0
+    for record in records:
+        area = observation_area(record)
+        dimension_ids = []
+        for i, dimension in enumerate(record['dimensions']):
+            if i == area:
+                values = (('area_type', dimension['dimension_id']), ('area_code', dimension['option_id']),
+                          ('area', dimension.get('option')))
+            elif labels:
+                values = ((dimension['dimension_id'], dimension['option_id']),
+                          (dimension['dimension_id'] + '_label', dimension.get('option')))
+            else:
+                values = ((dimension['dimension_id'], dimension['option_id']),)
+            if i != area:
+                dimension_ids.append(dimension['dimension_id'])
+            for name, value in values:
+                column = columns.get(name)
+                if column is None:
+                    column = columns[name] = [None] * rows
+                column.append(value)
+
+        columns['population_type'].append(record.get('population-type'))
+        columns['dimension_key'].append(dimension_key(dimension_ids))
+        observations.append(record['observation'])
+        rows += 1
+        for column in columns.values():
+            if len(column) < rows:
+                column.append(None)
+
+    table = pa.table(
+        {name: pa.array(values, type=pa.string()) for name, values in columns.items()}
+    ).append_column('observation', pa.array(observations, type=pa.int64()))
+
+    if return_type == "arrow":
+        return table
+    if return_type == "pandas":
+        return table.to_pandas()
+    return pl.from_arrow(table)
@@ -0,0 +1,209 @@
+import argparse
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import groupby
+
+from ukcensus.Estimate import CrawlEstimate
+from ukcensus.FetchedIndex import FetchedIndex
+from ukcensus.Metrics import configure_logging, log, metrics
+from ukcensus.Query import Query
+from ukcensus.RateLimiter import get_limiter
+from ukcensus.utils import generate_subsets
+
+DEFAULT_RATE_LIMIT_FILE = "ukcensus-ratelimit.json"
+
+
+class Shard(namedtuple("Shard", ["population_type", "dimension_ids", "area_type", "area_codes"])):
+    """
+    Slice of a crawl handed to one worker process: one population type,
+    dimension combination and area type, and a run of its area codes.
+    """
+
+    def units(self):
+        for area_code in self.area_codes:
+            yield self.population_type, list(self.dimension_ids), self.area_type, area_code
+
+    def describe(self):
+        return "{} {} {} {}..{} ({} areas)".format(self.population_type, ",".join(self.dimension_ids), self.area_type,
+                                                  self.area_codes[0], self.area_codes[-1], len(self.area_codes))
+
+
+def plan_shards(api, population_type, dimension_sets, shard_size=1000, estimate=None):
+    """
+    Splits the missing units of population_type into Shards of at most
+    shard_size areas, skipping those already stored.
+
+    dimension_sets -> dimension combinations, e.g. from utils.generate_subsets
+    estimate -> CrawlEstimate counting the skipped areas, for dry runs
+    """
+    fetched = FetchedIndex.from_store(api, population_type, api.observation_table)
+    area_codes = api.get_area_codes(population_type)
+    areas = sorted(zip(area_codes['area_type'], area_codes['area_code']))
+
+    for dimension_ids in dimension_sets:
+        dimension_ids = tuple(dimension_ids)
+        for area_type, group in groupby(areas, key=lambda area: area[0]):
+            group = [area_code for _, area_code in group]
+            codes = [area_code for area_code in group if not fetched.has(dimension_ids, area_type, area_code)]
+            if estimate is not None:
+                estimate.skip(len(group) - len(codes))
+            for start in range(0, len(codes), shard_size):
+                yield Shard(population_type, dimension_ids, area_type, codes[start:start + shard_size])
+
+
+def worker_settings(api):
+    """
+    The plain settings of api, enough to rebuild it in a worker process.
+    The limiter always gets a state file so every worker on the host draws
+    from one rate budget.
+    """
+    settings = {name: value for name, value in vars(api).items()
+                if name != "_storage" and isinstance(value, (str, int, float, bool, type(None)))}
+    settings["rate_limit_file"] = api.limiter.path or get_limiter(DEFAULT_RATE_LIMIT_FILE).path
+    settings["rate_limit_windows"] = api.limiter.windows
+    settings["rate_limit_pace"] = api.limiter.interval > 0
+    settings["cache_enabled"] = api.cache is not None
+    return settings
+
+
+_worker_api = None
+
+
+def init_worker(settings):
+    from ukcensus.CensusData import RateLimitedAPI
+
+    global _worker_api
+    api = RateLimitedAPI()
+    for name, value in settings.items():
+        if hasattr(api, name):
+            setattr(api, name, value)
+    api.limiter = get_limiter(settings["rate_limit_file"], settings["rate_limit_windows"], settings["rate_limit_pace"])
+    if not settings["cache_enabled"]:
+        api.cache = None
+    _worker_api = api
+
+
+def crawl_shard(shard):
+    result = _worker_api.crawl(shard.units())
+    return dict(result or {}, pid=os.getpid(), metrics=metrics.snapshot(reset=True))
+
+
+def run_shards(api, shards, processes=None):
+    """
+    Crawls the shards in a pool of worker processes and collects their
+    results and merges their metrics into this process's. Workers are
+    spawned, not forked, so none of them inherits the coordinator's
+    database or HTTP connections; at most two shards per worker are queued
+    at a time.
+
+    processes -> worker processes, one per core by default
+    """
+    processes = processes or os.cpu_count()
+    # the tables are created here so the workers never race to create them
+    api.create_table_if_not_exists(api.observation_table)
+    if api.storage.manifest:
+        api.manifest()
+    api.limiter = get_limiter(worker_settings(api)["rate_limit_file"], api.limiter.windows, api.limiter.interval > 0)
+
+    start = time.time()
+    summary = {"shards": 0, "failed": 0, "fetched": 0, "written": 0}
+    shards = iter(shards)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(worker_settings(api),)) as executor:
+        running = {}
+        while True:
+            for shard in shards:
+                running[executor.submit(crawl_shard, shard)] = shard
+                if len(running) >= processes * 2:
+                    break
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = running.pop(future)
+                summary["shards"] += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    summary["failed"] += 1
+                    log.warning("shard %s failed: %s", shard.describe(), e)
+                    continue
+                metrics.merge(result["metrics"])
+                summary["fetched"] += result.get("fetched", 0)
+                summary["written"] += result.get("written", 0)
+                log.info("shard %s done in worker %s: %s rows", shard.describe(), result["pid"], result.get("written", 0))
+
+    summary["elapsed"] = time.time() - start
+    log.info("{shards} shards ({failed} failed), {written} rows written in {elapsed:.1f}s".format(**summary))
+    return summary
+
+
+def microdata_population_types(api):
+    query = Query("population-types").select(population="data->>'name'").where("data->>'type'", "microdata")
+    return api.run_query(query)['population'].to_list()
+
+
+def population_dimensions(api, population_type):
+    query = Query("dimensions").select(dimension="data->>'id'").where("data->>'population-type'", population_type)
+    return api.run_query(query)['dimension'].to_list()
+
+
+def crawl(api, population_types=None, dimensions=None, how="all", n=None, processes=None, shard_size=1000, dry_run=False):
+    """
+    Shards the crawl of every population type and runs it with run_shards.
+
+    population_types -> all microdata population types by default
+    dimensions -> lists of dimension ids combined by utils.generate_subsets,
+                  every dimension of the population type on its own by default
+    dry_run -> only report what the crawl would cost, see Estimate.CrawlEstimate
+    """
+    estimate = CrawlEstimate(api) if dry_run else None
+
+    def shards():
+        for population_type in population_types or microdata_population_types(api):
+            if dimensions:
+                dimension_sets = generate_subsets(dimensions, how=how, n=n, max_dimensions=api.max_dimensions)
+            else:
+                dimension_sets = [[dimension_id] for dimension_id in population_dimensions(api, population_type)]
+            for shard in plan_shards(api, population_type, dimension_sets, shard_size, estimate):
+                yield shard
+
+    if dry_run:
+        return api.estimate_crawl((unit for shard in shards() for unit in shard.units()), estimate)
+    return run_shards(api, shards(), processes)
+
+
+def main(argv=None):
+    from ukcensus.CensusData import RateLimitedAPI
+
+    parser = argparse.ArgumentParser(description="Crawl census observations with a pool of worker processes")
+    parser.add_argument("--population-type", nargs="*", dest="population_types",
+                        help="population types to crawl, all microdata ones by default")
+    parser.add_argument("--dimensions", nargs="+", action="append",
+                        help="dimension ids to combine, repeat for each list; every dimension on its own by default")
+    parser.add_argument("--how", choices=["all", "any"], default="all", help="see utils.generate_subsets")
+    parser.add_argument("-n", type=int, help="dimensions taken at a time")
+    parser.add_argument("--processes", type=int, help="worker processes, [CRAWL] processes or one per core by default")
+    parser.add_argument("--shard-size", type=int, help="areas per shard, [CRAWL] shard_size by default")
+    parser.add_argument("--dry-run", action="store_true", help="only estimate the crawl")
+    parser.add_argument("--metrics", help="file the metrics are written to, [LOG] metrics_path by default")
+    parser.add_argument("--log-level", help="DEBUG logs every request, [LOG] level by default")
+    args = parser.parse_args(argv)
+
+    api = RateLimitedAPI()
+    if args.log_level:
+        configure_logging(args.log_level)
+    result = crawl(api, population_types=args.population_types, dimensions=args.dimensions, how=args.how, n=args.n,
+                   processes=args.processes or api.crawl_processes, shard_size=args.shard_size or api.shard_size,
+                   dry_run=args.dry_run)
+    if args.metrics or api.metrics_path:
+        metrics.write(args.metrics or api.metrics_path)
+    return result
+
+
+if __name__ == "__main__":
+    main()
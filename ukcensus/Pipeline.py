@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+
+from ukcensus.AsyncCrawler import AsyncCrawler
+from ukcensus.Metrics import log
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def record(self, rows, busy=0.0, blocked=0.0):
+        with self.lock:
+            self.batches += 1
+            self.rows += rows
+            self.busy += busy
+            self.blocked += blocked
+
+    def report(self, elapsed):
+        rate = self.rows / elapsed if elapsed else 0
+        line = "{}: {} batches, {} rows, {:.1f} rows/s".format(self.name, self.batches, self.rows, rate)
+        if self.busy:
+            line += ", busy {:.1f}s".format(self.busy)
+        if self.blocked:
+            line += ", blocked on queue {:.1f}s".format(self.blocked)
+        return line
+
+
+def buffer_items(writer, unit, items):
+    writer.extend(items)
+
+
+class Pipeline:
+    """
+    Overlaps fetching and writing: AsyncCrawler workers push each unit's
+    rows onto a bounded queue and writer threads drain it into a shared
+    BulkWriter. A full queue blocks the fetchers, so memory stays bounded.
+
+    api -> RateLimitedAPI used for both stages
+    table_name -> table the rows are written to
+    writers -> number of writer threads
+    queue_size -> batches allowed to wait between the stages
+    store -> called as store(writer, unit, items) by the writer threads,
+             defaults to buffering the items in the writer
+    on_error -> passed to AsyncCrawler.run
+    """
+    done = object()
+
+    def __init__(self, api, table_name="data_mt", writers=2, queue_size=64, store=None, on_error=None):
+        self.api = api
+        self.table_name = table_name
+        self.writers = writers
+        self.store = store or buffer_items
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.fetch_stats = StageStats("fetch")
+        self.write_stats = StageStats("write")
+        self.error = None
+
+    def put(self, unit, items):
+        if self.error is not None:
+            raise self.error
+        start = time.monotonic()
+        self.queue.put((unit, items))
+        self.fetch_stats.record(len(items), blocked=time.monotonic() - start)
+
+    def drain(self, writer):
+        while True:
+            entry = self.queue.get()
+            if entry is self.done:
+                return
+            if self.error is not None:
+                continue
+            unit, items = entry
+            start = time.monotonic()
+            try:
+                self.store(writer, unit, items)
+            except Exception as e:
+                self.error = e
+                continue
+            self.write_stats.record(len(items), busy=time.monotonic() - start)
+
+    def run(self, units):
+        """
+        units -> iterable of (endpoint, tags) as taken by AsyncCrawler.run
+        """
+        start = time.monotonic()
+        writer = self.api.bulk_writer(self.table_name)
+        threads = [threading.Thread(target=self.drain, args=(writer,), daemon=True) for _ in range(self.writers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            AsyncCrawler(self.api, self.api.concurrency).crawl(units, self.put, self.on_error)
+        finally:
+            for _ in threads:
+                self.queue.put(self.done)
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+        flush_start = time.monotonic()
+        writer.close()
+        self.write_stats.busy += time.monotonic() - flush_start
+
+        elapsed = time.monotonic() - start
+        log.info(self.fetch_stats.report(elapsed))
+        log.info(self.write_stats.report(elapsed))
+        return {"elapsed": elapsed, "fetched": self.fetch_stats.rows, "written": writer.rows_written}
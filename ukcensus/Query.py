@@ -0,0 +1,92 @@
+import hashlib
+
+
+def like_escape(text):
+    """
+    text with the LIKE wildcards escaped, to match it literally
+    """
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def statement_name(sql):
+    """
+    Name sql is prepared under, the same text always gets the same name.
+    """
+    return "ukcensus_{}".format(hashlib.md5(sql.encode()).hexdigest()[:16])
+
+
+class Query:
+    """
+    SELECT over one table built from select / where calls and rendered as
+    parameterised SQL, so the statement text stays the same whatever the
+    values and can be prepared once per connection.
+
+        Query("area-infos").select(area_code="data->>'id'").where_in("data->>'area_type'", ['lsoa', 'msoa'])
+
+    table -> table to select from
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = []
+        self.conditions = []
+        self.is_distinct = False
+
+    def select(self, *expressions, **aliases):
+        """
+        expressions -> selected as is
+        aliases -> name=expression, selected as `expression as name`
+        """
+        self.columns.extend(expressions)
+        self.columns.extend("{} as {}".format(expression, name) for name, expression in aliases.items())
+        return self
+
+    def distinct(self):
+        self.is_distinct = True
+        return self
+
+    def where(self, expression, value):
+        self.conditions.append((expression, "=", value))
+        return self
+
+    def where_in(self, expression, values):
+        self.conditions.append((expression, "in", list(values)))
+        return self
+
+    def where_like(self, expression, pattern):
+        """
+        pattern -> LIKE pattern, backslash escapes % and _
+        """
+        self.conditions.append((expression, "like", pattern))
+        return self
+
+    def render(self, dialect="postgres"):
+        """
+        Returns (sql, params). postgres numbers the placeholders $1, $2...
+        for PREPARE and passes where_in values as one array, psycopg2 does
+        the same with %s placeholders for cursors that can't run a prepared
+        statement, sqlite uses ? placeholders, one per value.
+        """
+        params = []
+
+        def placeholder(value):
+            params.append(value)
+            if dialect == "postgres":
+                return "${}".format(len(params))
+            return "%s" if dialect == "psycopg2" else "?"
+
+        conditions = []
+        for expression, op, value in self.conditions:
+            if op == "in" and dialect in ("postgres", "psycopg2"):
+                conditions.append("{} = ANY({})".format(expression, placeholder(value)))
+            elif op == "in":
+                conditions.append("{} IN ({})".format(expression, ", ".join(placeholder(v) for v in value) or "NULL"))
+            elif op == "like":
+                conditions.append("{} LIKE {} ESCAPE '\\'".format(expression, placeholder(value)))
+            else:
+                conditions.append("{} {} {}".format(expression, op, placeholder(value)))
+
+        sql = 'SELECT {}{} FROM "{}"'.format("DISTINCT " if self.is_distinct else "", ", ".join(self.columns) or "*", self.table)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql, params
@@ -0,0 +1,103 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from ukcensus.Metrics import metrics
+
+
+class RateLimiter:
+    """
+    Sliding-window limiter that hands out request slots in order.
+
+    windows -> (limit, period) pairs, never more than limit calls in any period
+    path -> state file shared by every process on the host, None keeps the
+            state in this process only
+    pace -> space calls evenly at the sustained rate instead of bursting
+    """
+
+    def __init__(self, windows=((80, 10), (180, 60)), path=None, pace=True):
+        self.windows = list(windows)
+        self.path = path
+        self.longest = max(period for _, period in self.windows)
+        self.interval = max(period / limit for limit, period in self.windows) if pace else 0
+        self.lock = threading.Lock()
+        self.calls = []
+
+    @contextmanager
+    def shared_state(self):
+        if self.path is None:
+            yield self.calls
+            return
+
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                text = f.read()
+                calls = json.loads(text) if text else []
+                yield calls
+                f.seek(0)
+                f.truncate()
+                json.dump(calls, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reserve(self):
+        """
+        Books the next free slot and returns how long to wait for it.
+        """
+        with self.lock, self.shared_state() as calls:
+            now = time.time()
+            calls[:] = [t for t in calls if t > now - self.longest]
+
+            start = now
+            if calls:
+                start = max(start, calls[-1] + self.interval)
+
+            moved = True
+            while moved:
+                moved = False
+                for limit, period in self.windows:
+                    in_window = [t for t in calls if t > start - period]
+                    if len(in_window) >= limit:
+                        start = in_window[-limit] + period
+                        moved = True
+
+            calls.append(start)
+        if start > now:
+            metrics.inc("ukcensus_ratelimit_sleep_seconds_total", start - now)
+        return start - now
+
+    def acquire(self):
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(path=None, windows=((80, 10), (180, 60)), pace=True):
+    """
+    Returns the limiter for path, windows and pace, creating it on first use
+    so every RateLimitedAPI in the process with the same limits draws from
+    the same budget.
+
+    path -> state file, relative paths live in the system temp directory
+    """
+    if path and not os.path.isabs(path):
+        path = os.path.join(tempfile.gettempdir(), path)
+    windows = tuple(tuple(window) for window in windows)
+
+    with _limiters_lock:
+        key = (path, windows, pace)
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(windows=windows, path=path, pace=pace)
+        return _limiters[key]
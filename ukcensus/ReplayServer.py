@@ -0,0 +1,246 @@
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from ukcensus.ResponseCache import endpoint_kind
+
+DEFAULT_COLLECTION = "cencus.postman_collection.json"
+
+AREA_TYPES = {"ctry": 1, "rgn": 9, "msoa": 200, "lsoa": 1000}
+
+AREA_PREFIXES = {"ctry": "E92", "rgn": "E12", "ltla": "E06", "msoa": "E02", "lsoa": "E01", "oa": "E00"}
+
+
+def load_responses(path=DEFAULT_COLLECTION):
+    """
+    Saved response bodies of the Postman collection by endpoint kind. The
+    items of a kind saved more than once are merged, for observations the
+    largest response is kept.
+    """
+    with open(path) as f:
+        collection = json.load(f)
+
+    responses = {}
+    for item in collection["item"]:
+        for response in item.get("response", []):
+            url = response["originalRequest"]["url"]
+            kind = endpoint_kind(url["raw"] if isinstance(url, dict) else url)
+            body = json.loads(response["body"])
+            saved = responses.setdefault(kind, body)
+            if "items" in body and saved is not body:
+                known = {json.dumps(item, sort_keys=True) for item in saved["items"]}
+                saved["items"].extend(item for item in body["items"] if json.dumps(item, sort_keys=True) not in known)
+            elif len(body.get("observations", [])) > len(saved.get("observations", [])):
+                responses[kind] = body
+    return responses
+
+
+class ReplayServer:
+    """
+    Local stand-in for the ONS API that answers from the responses saved in
+    the Postman collection, for offline benchmarks.
+
+    List endpoints are paginated with limit / offset over the saved items,
+    areas and area types are generated in the shape of the saved ones, and
+    census-observations returns one observation per area and combination of
+    options, with the options of the saved observations and categorisations
+    where they name the dimension.
+
+    area_types -> area type -> number of areas served for it
+    population_types -> names added to population-types as microdata
+    latency, jitter -> seconds every response is delayed, plus up to jitter
+    error_rate -> share of requests answered 429 with Retry-After: retry_after
+    max_limit -> larger page sizes are refused with 400
+    max_areas -> observation requests naming more areas are refused with 400
+    options -> options of a dimension the collection has none saved for
+    """
+
+    def __init__(self, collection=DEFAULT_COLLECTION, area_types=None, population_types=("UR",), latency=0, jitter=0,
+                 error_rate=0, retry_after=0, max_limit=500, max_areas=None, options=6, seed=0, port=0):
+        self.responses = load_responses(collection)
+        self.area_types = dict(area_types or AREA_TYPES)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.max_limit = max_limit
+        self.max_areas = max_areas
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+        self.population_types = list(self.responses["population-types"]["items"])
+        self.population_types.extend({"name": name, "label": name, "description": name, "type": "microdata"}
+                                     for name in population_types)
+        self.dimensions = self.responses["dimensions"]["items"]
+        self.options = self.saved_options(options)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def saved_options(self, options):
+        saved = {}
+        for observation in self.responses["census-observations"]["observations"]:
+            for dimension in observation["dimensions"]:
+                known = saved.setdefault(dimension["dimension_id"], {})
+                known[dimension["option_id"]] = (dimension["dimension"], dimension["option"])
+        for item in self.responses["categorisations"]["items"]:
+            saved.setdefault(item["id"], {category["id"]: (item["label"], category["label"])
+                                          for category in item["categories"]})
+        self.default_options = {str(i): (None, "Category {}".format(i)) for i in range(1, options + 1)}
+        return saved
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/v1".format(self.server.server_port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def area_codes(self, area_type):
+        prefix = AREA_PREFIXES.get(area_type, "E99")
+        return ["{}{:06d}".format(prefix, i + 1) for i in range(self.area_types.get(area_type, 0))]
+
+    def page(self, items, query):
+        limit = int(query.get("limit", ["20"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        if limit > self.max_limit:
+            return 400, {"errors": ["limit must be at most {}".format(self.max_limit)]}
+        page = items[offset:offset + limit]
+        return 200, {"limit": limit, "offset": offset, "count": len(page), "total_count": len(items), "items": page}
+
+    def observations(self, area_type, area_codes, dimension_ids):
+        options = [sorted(self.options.get(dimension_id, self.default_options).items()) for dimension_id in dimension_ids]
+        observations = []
+        for area_code in area_codes:
+            for combination in itertools.product(*options):
+                dimensions = [{"dimension": area_type, "dimension_id": area_type, "option": area_code, "option_id": area_code}]
+                dimensions.extend({"dimension": label or dimension_id, "dimension_id": dimension_id,
+                                   "option": option, "option_id": option_id}
+                                  for dimension_id, (option_id, (label, option)) in zip(dimension_ids, combination))
+                key = ",".join([area_code] + [option_id for option_id, _ in combination])
+                observations.append({"dimensions": dimensions, "observation": zlib.crc32(key.encode()) % 1000})
+        return observations
+
+    def respond(self, path, query):
+        """
+        (status, body) for a GET of path, the API path after /v1.
+        """
+        parts = [part for part in path.split("/") if part]
+        if parts == ["population-types"]:
+            return self.page(self.population_types, query)
+        if len(parts) < 3 or parts[0] != "population-types":
+            return 404, {"errors": ["not found"]}
+
+        rest = parts[2:]
+        if rest == ["area-types"]:
+            items = [{"id": area_type, "label": area_type, "description": area_type, "total_count": count}
+                     for area_type, count in self.area_types.items()]
+            return self.page(items, query)
+        if len(rest) == 3 and rest[0] == "area-types" and rest[2] == "areas":
+            area_type = rest[1]
+            return self.page([{"id": code, "label": code, "area_type": area_type}
+                              for code in self.area_codes(area_type)], query)
+        if rest == ["dimensions"]:
+            q = query.get("q", [""])[0]
+            return self.page([item for item in self.dimensions if q in item["id"]], query)
+        if len(rest) == 3 and rest[0] == "dimensions" and rest[2] == "categorisations":
+            dimension_id = rest[1]
+            options = self.options.get(dimension_id, self.default_options)
+            label = next(iter(options.values()))[0] or dimension_id
+            return self.page([{"id": dimension_id, "label": label,
+                               "categories": [{"id": option_id, "label": option} for option_id, (_, option) in options.items()]}],
+                             query)
+        if rest == ["census-observations"]:
+            area_type, *area_codes = query["area-type"][0].split(",")
+            dimension_ids = query["dimensions"][0].split(",") if query.get("dimensions") else []
+            if self.max_areas and len(area_codes) > self.max_areas:
+                return 400, {"errors": ["too many areas, at most {}".format(self.max_areas)]}
+            observations = self.observations(area_type, area_codes, dimension_ids)
+            return 200, {"observations": observations, "links": {"self": {"href": path}},
+                         "total_observations": len(observations), "blocked_areas": 0,
+                         "total_areas": len(area_codes), "areas_returned": len(area_codes)}
+        return 404, {"errors": ["not found"]}
+
+    def handler(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                path = url.path[len("/v1"):] if url.path.startswith("/v1") else url.path
+                kind = endpoint_kind(path)
+                with replay.lock:
+                    delay = replay.latency + replay.random.uniform(0, replay.jitter)
+                    throttled = replay.random.random() < replay.error_rate
+                if delay:
+                    time.sleep(delay)
+
+                headers = {}
+                if throttled:
+                    status, body = 429, {"errors": ["too many requests"]}
+                    headers["Retry-After"] = str(replay.retry_after)
+                else:
+                    status, body = replay.respond(path, parse_qs(url.query))
+                with replay.lock:
+                    replay.calls[(kind, status)] += 1
+
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the saved ONS API responses locally")
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--areas", nargs="*", default=[], metavar="TYPE=COUNT",
+                        help="areas served per area type, e.g. lsoa=1000")
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered 429")
+    parser.add_argument("--retry-after", type=float, default=0)
+    parser.add_argument("--max-areas", type=int)
+    args = parser.parse_args()
+
+    area_types = {area_type: int(count) for area_type, count in (area.split("=") for area in args.areas)} or None
+    server = ReplayServer(args.collection, area_types=area_types, latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, retry_after=args.retry_after, max_areas=args.max_areas,
+                          port=args.port)
+    print("replaying {} on {}, set [API] base_url to it".format(args.collection, server.url))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.server.server_close()
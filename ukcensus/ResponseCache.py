@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import urlencode, urlsplit
+
+CacheEntry = namedtuple("CacheEntry", ["key", "body", "etag", "last_modified", "fresh"])
+
+DEFAULT_TTLS = {
+    "population-types": 7 * 24 * 3600,
+    "area-types": 7 * 24 * 3600,
+    "areas": 7 * 24 * 3600,
+    "dimensions": 7 * 24 * 3600,
+    "categorisations": 7 * 24 * 3600,
+    "census-observations": 0,
+}
+
+
+def endpoint_kind(url):
+    """
+    Last path segment of the url, e.g. `dimensions` or `census-observations`.
+    """
+    return urlsplit(url).path.rstrip('/').split('/')[-1]
+
+
+class ResponseCache:
+    """
+    On-disk cache of JSON responses keyed on url plus params, with a TTL per
+    endpoint kind and least-recently-used eviction above max_size bytes.
+
+    path -> directory holding the cache database
+    max_size -> bytes of compressed bodies kept on disk
+    ttls -> seconds each endpoint kind stays fresh, 0 disables caching it
+    """
+
+    def __init__(self, path, max_size=512 * 1024 * 1024, ttls=None):
+        os.makedirs(path, exist_ok=True)
+        self.max_size = max_size
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(path, "responses.sqlite3"), timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    body BLOB,
+                    etag TEXT,
+                    last_modified TEXT,
+                    expires_at REAL,
+                    last_access REAL,
+                    size INTEGER
+                )
+                """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def key(self, url, params={}):
+        query = urlencode(sorted((k, str(v)) for k, v in params.items()))
+        return "{}?{}".format(url, query) if query else url
+
+    def ttl(self, url):
+        return self.ttls.get(endpoint_kind(url), 0)
+
+    def get(self, url, params={}):
+        key = self.key(url, params)
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT body, etag, last_modified, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+
+        body, etag, last_modified, expires_at = row
+        return CacheEntry(key, json.loads(zlib.decompress(body)), etag, last_modified, expires_at > now)
+
+    def is_fresh(self, url, params={}):
+        """
+        Whether a fresh entry is cached, without reading or touching it.
+        """
+        if self.ttl(url) <= 0:
+            return False
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT expires_at FROM responses WHERE key = ?", (self.key(url, params),)
+            ).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def put(self, url, params, result, etag=None, last_modified=None):
+        ttl = self.ttl(url)
+        if ttl <= 0:
+            return
+        body = zlib.compress(json.dumps(result).encode())
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.key(url, params), body, etag, last_modified, now + ttl, now, len(body)),
+            )
+            self.evict()
+
+    def touch(self, entry, url):
+        """
+        Marks a revalidated (304) entry fresh for another TTL.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE responses SET expires_at = ? WHERE key = ?", (time.time() + self.ttl(url), entry.key)
+            )
+
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            stale.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
@@ -0,0 +1,247 @@
+import argparse
+import json
+
+import psycopg2
+from psycopg2.errors import UndefinedTable
+
+from ukcensus.Metrics import log
+
+# (index name, definition, required extension) for every column the lookups
+# filter on, so none of them has to scan the JSONB blobs
+TABLE_INDEXES = {
+    "population-types": [
+        ("type", "((data->>'type'))", None),
+    ],
+    "area-types": [
+        ("population_type", "((data->>'population-type'), (data->>'id'))", None),
+    ],
+    "area-infos": [
+        ("area_type", "((data->>'area_type'))", None),
+    ],
+    "dimensions": [
+        ("population_type", "((data->>'population-type'), (data->>'id'))", None),
+        ("id", "((data->>'id'))", None),
+        ("id_trgm", "USING GIN ((data->>'id') gin_trgm_ops)", "pg_trgm"),
+    ],
+    "categories": [
+        ("dimension", "((data->>'dimension'))", None),
+    ],
+    "data_mt": [
+        ("population_type_dimension", "((data->>'population-type'), (data->>'dimension-id'))", None),
+        ("dimension", "((data->>'dimension-id'))", None),
+    ],
+    "observations": [
+        ("work_unit", "(population_type, dimension_key, area_type, area_code)", None),
+    ],
+}
+
+OBSERVATION_COLUMNS = (
+    "population_type", "area_type", "area_code", "dimension_key",
+    "dimension_ids", "option_ids", "observation",
+)
+
+CREATE_OBSERVATIONS = """
+    CREATE TABLE IF NOT EXISTS "observations" (
+        id BIGSERIAL PRIMARY KEY,
+        population_type TEXT NOT NULL,
+        area_type TEXT NOT NULL,
+        area_code TEXT NOT NULL,
+        dimension_key TEXT NOT NULL,
+        dimension_ids TEXT[] NOT NULL,
+        option_ids TEXT[] NOT NULL,
+        observation INTEGER NOT NULL
+    )
+    """
+
+
+def dimension_list(dimension_id):
+    """
+    The 'dimension-id' tag of a data_mt row as a list, it is stored as a
+    single id by get_data_final and as a list by get_multi_final_data.
+    """
+    if isinstance(dimension_id, str):
+        return dimension_id.split(',')
+    return list(dimension_id)
+
+
+def parse_dimension_tag(tag):
+    """
+    'dimension-id' as read back with data->>'dimension-id': JSON text for
+    the lists get_multi_final_data stores, a plain id otherwise.
+    """
+    if tag.startswith('['):
+        return json.loads(tag)
+    return dimension_list(tag)
+
+
+def dimension_key(dimension_ids):
+    return ','.join(sorted(dimension_ids))
+
+
+def observation_area(record):
+    """
+    Index of the area in record['dimensions']: the one dimension not named
+    in the 'dimension-id' tag, the first one for untagged records.
+    """
+    requested = dimension_list(record['dimension-id']) if 'dimension-id' in record else []
+    for i, dimension in enumerate(record['dimensions']):
+        if dimension['dimension_id'] not in requested:
+            return i
+    return 0
+
+
+def observation_row(item):
+    """
+    Turns a tagged census-observations item into a row of the typed
+    observations table, with the area picked by observation_area.
+    """
+    area_index = observation_area(item)
+    area = item['dimensions'][area_index]
+    dimensions = item['dimensions'][:area_index] + item['dimensions'][area_index + 1:]
+    dimension_ids = [dimension['dimension_id'] for dimension in dimensions]
+    option_ids = [dimension['option_id'] for dimension in dimensions]
+
+    return (
+        item['population-type'], area['dimension_id'], area['option_id'], dimension_key(dimension_ids),
+        dimension_ids, option_ids, int(item['observation']),
+    )
+
+
+def index_name(table_name, name):
+    return "{}_{}_idx".format(table_name.replace('-', '_'), name)
+
+
+def index_statements(table_name, concurrently=False):
+    """
+    Yields (statement, extension) for each index declared for table_name.
+    """
+    for name, definition, extension in TABLE_INDEXES.get(table_name, []):
+        statement = 'CREATE INDEX {}IF NOT EXISTS "{}" ON "{}" {}'.format(
+            "CONCURRENTLY " if concurrently else "", index_name(table_name, name), table_name, definition)
+        yield statement, extension
+
+
+def create_indexes(cursor, table_name):
+    """
+    Declares the indexes inside the caller's transaction. Indexes whose
+    extension can't be installed are skipped.
+    """
+    for statement, extension in index_statements(table_name):
+        if extension is None:
+            cursor.execute(statement)
+            continue
+        cursor.execute("SAVEPOINT create_index")
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS {}".format(extension))
+            cursor.execute(statement)
+        except psycopg2.Error as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT create_index")
+            log.warning("skipping %s: %s", statement, str(e).strip())
+        cursor.execute("RELEASE SAVEPOINT create_index")
+
+
+def backfill_indexes(api, tables=None):
+    """
+    Builds missing indexes on existing tables with CREATE INDEX CONCURRENTLY,
+    so writers are not blocked while data_mt is indexed. Other storages
+    build them with their own DDL.
+
+    tables -> names to index, defaults to every table in TABLE_INDEXES
+    """
+    if api.storage.name != "postgres":
+        with api.storage.connection() as conn:
+            for table_name in tables or TABLE_INDEXES:
+                if not api.storage.table_exists(table_name):
+                    log.warning("table %s does not exist yet", table_name)
+                    continue
+                log.info("indexing %s", table_name)
+                api.storage.create_indexes(conn, table_name)
+        return
+
+    with api.db_pool.connection() as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for table_name in tables or TABLE_INDEXES:
+                    for statement, extension in index_statements(table_name, concurrently=True):
+                        log.info(statement)
+                        try:
+                            if extension is not None:
+                                cursor.execute("CREATE EXTENSION IF NOT EXISTS {}".format(extension))
+                            cursor.execute(statement)
+                        except UndefinedTable:
+                            log.warning("table %s does not exist yet", table_name)
+                            break
+                        except psycopg2.Error as e:
+                            log.warning("skipping: %s", str(e).strip())
+        finally:
+            conn.autocommit = False
+
+
+def migrate_observations(api, source="data_mt", chunk_size=10000):
+    """
+    Copies the JSONB observation rows of source into the typed
+    observations table, streaming them through a server-side cursor.
+
+    The table has no natural key to deduplicate on, so the migration is
+    refused when it already holds rows of a population type in source,
+    e.g. from an earlier run.
+    """
+    if api.storage.name != "postgres":
+        raise ValueError("migrating observations needs the postgres storage, not {}".format(api.storage.name))
+
+    with api.db_pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(CREATE_OBSERVATIONS)
+            create_indexes(cursor, "observations")
+            cursor.execute('SELECT DISTINCT population_type FROM "observations"')
+            migrated = [population_type for (population_type,) in cursor.fetchall()]
+            if migrated:
+                cursor.execute("""
+                    SELECT DISTINCT data->>'population-type' FROM "{}" WHERE data->>'population-type' = ANY(%s)
+                    """.format(source), [migrated])
+                overlap = sorted(population_type for (population_type,) in cursor.fetchall())
+                if overlap:
+                    raise ValueError("observations already holds rows of {} from {}, not migrating it again".format(
+                        ", ".join(overlap), source))
+
+    writer = api.bulk_writer("observations")
+    skipped = 0
+    with api.db_pool.connection() as conn:
+        with conn.cursor(name="migrate_observations") as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute('SELECT data FROM "{}"'.format(source))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                items = []
+                for (data,) in rows:
+                    if 'dimensions' in data and 'dimension-id' in data:
+                        items.append(data)
+                    else:
+                        skipped += 1
+                writer.extend(items)
+                log.info("migrated %s rows", writer.rows_written + len(writer.items))
+    writer.close()
+    log.info("migrated %s rows from %s, skipped %s", writer.rows_written, source, skipped)
+    return writer.rows_written
+
+
+if __name__ == "__main__":
+    from ukcensus.CensusData import RateLimitedAPI
+
+    parser = argparse.ArgumentParser(description="Maintain the census cache tables")
+    parser.add_argument("command", choices=["backfill-indexes", "migrate-observations"])
+    parser.add_argument("tables", nargs="*", help="tables to index, all of them by default; "
+                                                  "for migrate-observations the JSONB table to copy, data_mt by default")
+    args = parser.parse_args()
+
+    if args.command == "backfill-indexes":
+        backfill_indexes(RateLimitedAPI(), args.tables)
+    elif args.command == "migrate-observations":
+        for source in args.tables or ["data_mt"]:
+            try:
+                migrate_observations(RateLimitedAPI(), source)
+            except ValueError as e:
+                parser.error(str(e))
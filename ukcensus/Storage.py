@@ -0,0 +1,306 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+import pandas as pd
+import pyarrow as pa
+from psycopg2.errors import UndefinedTable
+
+from ukcensus.BulkWriter import BulkWriter
+from ukcensus.Database import ConnectionPool, stream_query
+from ukcensus.Metrics import metrics
+from ukcensus.Query import Query, statement_name
+from ukcensus.Schema import CREATE_OBSERVATIONS, create_indexes, index_statements
+
+CREATE_CACHE_TABLE = """
+    CREATE TABLE IF NOT EXISTS "{}" (
+        id SERIAL PRIMARY KEY,
+        data JSONB
+    )
+    """
+
+sqlite3.register_converter("JSON", json.loads)
+
+
+class PostgresStorage:
+    """
+    Cache tables in a Postgres server: JSONB rows written with COPY, read
+    through the ConnectionPool, which is rebuilt in forked processes.
+
+    manifest -> the storage can hold the crawl manifest
+    connect_kwargs -> passed to ConnectionPool
+    """
+    name = "postgres"
+    manifest = True
+
+    def __init__(self, minconn=1, maxconn=10, health_check_interval=30, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+        self.connect_kwargs = connect_kwargs
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None or self._pool.pid != os.getpid():
+            self._pool = ConnectionPool(self.minconn, self.maxconn, self.health_check_interval, **self.connect_kwargs)
+        return self._pool
+
+    def connection(self):
+        return self.pool.connection()
+
+    def table_exists(self, table_name):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", ['"{}"'.format(table_name)])
+                return cursor.fetchone()[0] is not None
+
+    def create_table(self, table_name):
+        create_query = CREATE_OBSERVATIONS if table_name == "observations" else CREATE_CACHE_TABLE.format(table_name)
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", ['"{}"'.format(table_name)])
+                if cursor.fetchone()[0] is not None:
+                    return
+                cursor.execute(create_query)
+                create_indexes(cursor, table_name)
+
+    def insert(self, table_name, data):
+        with metrics.timer("ukcensus_db_seconds", operation="insert", table=table_name), self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('INSERT INTO "{}" (data) VALUES (%s)'.format(table_name), [json.dumps(data)])
+
+    def query(self, select_query):
+        with metrics.timer("ukcensus_db_seconds", operation="query"), self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(select_query)
+                results = cursor.fetchall()
+                columns = [x[0] for x in cursor.description]
+
+        return pd.DataFrame(data=results, columns=columns)
+
+    def run(self, query):
+        """
+        Runs a Query as a prepared statement. Each connection prepares a
+        statement once and executes it afterwards, skipping the parse and
+        plan on repeated lookups.
+        """
+        sql, params = query.render("postgres")
+        name = statement_name(sql)
+        with metrics.timer("ukcensus_db_seconds", operation="run", table=query.table), self.connection() as conn:
+            prepared = self.pool.statements(conn)
+            with conn.cursor() as cursor:
+                if name not in prepared:
+                    cursor.execute("PREPARE {} AS {}".format(name, sql))
+                    prepared.add(name)
+                if params:
+                    cursor.execute("EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(params))), params)
+                else:
+                    cursor.execute("EXECUTE {}".format(name))
+                results = cursor.fetchall()
+                columns = [x[0] for x in cursor.description]
+
+        return pd.DataFrame(data=results, columns=columns)
+
+    def iter_batches(self, select_query, chunk_size=10000):
+        """
+        select_query -> SQL text, or a Query rendered with %s parameters as
+                        server-side cursors can't run prepared statements
+        """
+        if isinstance(select_query, Query):
+            sql, params = select_query.render("psycopg2")
+            return stream_query(self.pool, sql, chunk_size, params or None)
+        return stream_query(self.pool, select_query, chunk_size)
+
+    def writer(self, table_name, **kwargs):
+        return BulkWriter(self.pool, table_name, **kwargs)
+
+
+class SQLiteConnection:
+    """
+    sqlite3 connection whose cursors work as context managers like
+    psycopg2's, so BulkWriter and the loaders can use either.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return closing(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+
+class SQLiteWriter(BulkWriter):
+    """
+    BulkWriter for SQLiteStorage, batches go in with executemany.
+    """
+
+    def copy(self, cursor, batch):
+        insert_query = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            self.table_name, ', '.join(self.columns), ', '.join('?' * len(self.columns)))
+        cursor.executemany(insert_query, [
+            tuple(json.dumps(value) if isinstance(value, (dict, list)) else value for value in self.to_row(item))
+            for item in batch
+        ])
+
+
+def sqlite_column(values):
+    """
+    Arrow type for a column of sqlite values, None when they are not all
+    numbers and the column is kept as strings.
+    """
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, int) for value in present):
+        return pa.int64()
+    if present and all(isinstance(value, (int, float)) for value in present):
+        return pa.float64()
+    return None
+
+
+class SQLiteStorage:
+    """
+    Cache tables in one SQLite file, no server needed. The JSON rows are
+    queried with the same ->> expressions as in Postgres and the declared
+    expression indexes are created, those needing a Postgres extension are
+    skipped. Each thread gets its own connection.
+
+    The crawl manifest and the typed observations table need Postgres, so
+    crawls run straight through the Pipeline and resume from FetchedIndex.
+
+    path -> database file
+    """
+    name = "sqlite"
+    manifest = False
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+    @property
+    def pool(self):
+        return self
+
+    def conn(self):
+        if getattr(self.local, 'conn', None) is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    @contextmanager
+    def connection(self):
+        conn = self.conn()
+        try:
+            yield SQLiteConnection(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    @contextmanager
+    def translate_errors(self):
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if str(e).startswith("no such table"):
+                raise UndefinedTable(str(e))
+            raise
+
+    def table_exists(self, table_name):
+        row = self.conn().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone()
+        return row is not None
+
+    def create_table(self, table_name):
+        if table_name == "observations":
+            raise ValueError("the typed observations table needs the postgres storage")
+        with self.connection() as conn:
+            conn.conn.execute("""
+                CREATE TABLE IF NOT EXISTS "{}" (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    data JSON
+                )
+                """.format(table_name))
+            self.create_indexes(conn, table_name)
+
+    def create_indexes(self, conn, table_name):
+        """
+        Declares the indexes of table_name, skipping those that need a
+        Postgres extension.
+        """
+        for statement, extension in index_statements(table_name):
+            if extension is None:
+                conn.conn.execute(statement)
+
+    def insert(self, table_name, data):
+        with metrics.timer("ukcensus_db_seconds", operation="insert", table=table_name), \
+                self.connection() as conn, self.translate_errors():
+            conn.conn.execute('INSERT INTO "{}" (data) VALUES (?)'.format(table_name), [json.dumps(data)])
+
+    def query(self, select_query):
+        with metrics.timer("ukcensus_db_seconds", operation="query"), self.connection() as conn, self.translate_errors():
+            cursor = conn.conn.execute(select_query)
+            results = cursor.fetchall()
+            columns = [x[0] for x in cursor.description]
+
+        return pd.DataFrame(data=results, columns=columns)
+
+    def run(self, query):
+        """
+        Runs a Query, sqlite3 keeps the compiled statements in its own
+        per-connection cache.
+        """
+        sql, params = query.render("sqlite")
+        with metrics.timer("ukcensus_db_seconds", operation="run", table=query.table), \
+                self.connection() as conn, self.translate_errors():
+            cursor = conn.conn.execute(sql, params)
+            results = cursor.fetchall()
+            columns = [x[0] for x in cursor.description]
+
+        return pd.DataFrame(data=results, columns=columns)
+
+    def iter_batches(self, select_query, chunk_size=10000):
+        """
+        Arrow record batches of at most chunk_size rows, column types taken
+        from the first batch; JSON columns come back as their text.
+
+        select_query -> SQL text or a Query
+        """
+        sql, params = select_query.render("sqlite") if isinstance(select_query, Query) else (select_query, ())
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with self.translate_errors():
+                cursor = conn.execute(sql, params)
+            types = None
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                columns = list(zip(*rows)) if rows else [()] * len(cursor.description)
+                if types is None:
+                    types = [sqlite_column(values) for values in columns]
+                    schema = pa.schema([(column[0], arrow_type or pa.string())
+                                        for column, arrow_type in zip(cursor.description, types)])
+                elif not rows:
+                    return
+                yield pa.record_batch([
+                    pa.array(values, type=arrow_type) if arrow_type is not None else
+                    pa.array([None if value is None else str(value) for value in values], type=pa.string())
+                    for values, arrow_type in zip(columns, types)
+                ], schema=schema)
+                if len(rows) < chunk_size:
+                    return
+        finally:
+            conn.close()
+
+    def writer(self, table_name, **kwargs):
+        return SQLiteWriter(self, table_name, **kwargs)
+
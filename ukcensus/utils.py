@@ -1,6 +1,48 @@
-from itertools import product
+from itertools import combinations, product
 
-def generate_subsets(set_list):
-    print("generating subsets")
-    temp =list(product(*set_list))
-    return temp
\ No newline at end of file
+from ukcensus.Metrics import log
+
+def generate_subsets(set_list, how="any", n=None, max_dimensions=None):
+    """
+    Lazily plans the dimension combinations to crawl, each one a sorted
+    tuple yielded once however many times the lists produce it. how and n
+    are checked when it is called, before any combination is planned.
+
+    set_list -> list of dimension id lists, e.g. one per filter
+    how -> any takes one dimension from each of n lists,
+           all takes every n dimensions of the lists together
+    n -> dimensions per combination, defaults to one per list
+    max_dimensions -> combinations with more dimensions are dropped
+    """
+    log.debug("generating subsets")
+    set_list = [[ids] if isinstance(ids, str) else list(ids) for ids in set_list]
+    if n is None:
+        n = len(set_list)
+
+    if how == "any":
+        if not 1 <= n <= len(set_list):
+            raise ValueError("n must be between 1 and the {} dimension lists for how=any".format(len(set_list)))
+        candidates = (combination for lists in combinations(set_list, n) for combination in product(*lists))
+    elif how == "all":
+        pooled = sorted({dimension_id for ids in set_list for dimension_id in ids})
+        if not 1 <= n <= len(pooled):
+            raise ValueError("n must be between 1 and the {} dimensions for how=all".format(len(pooled)))
+        candidates = combinations(pooled, n)
+    else:
+        raise ValueError("how can only be any or all")
+    return unique_subsets(candidates, max_dimensions)
+
+
+def unique_subsets(candidates, max_dimensions=None):
+    seen = set()
+    dropped = 0
+    for combination in candidates:
+        combination = tuple(sorted(combination))
+        if combination in seen:
+            continue
+        seen.add(combination)
+        if not combination or len(set(combination)) < len(combination) or (max_dimensions and len(combination) > max_dimensions):
+            dropped += 1
+            continue
+        yield combination
+    log.info("planned %s combinations, dropped %s", len(seen) - dropped, dropped)